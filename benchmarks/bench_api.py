@@ -0,0 +1,190 @@
+"""Concurrent latency benchmark for the CAR viewer API.
+
+Fires the same request at a running API with a fixed concurrency and prints
+throughput and latency percentiles, e.g.
+
+    python benchmarks/bench_api.py layers --car-code GO-5200134-... --concurrency 20
+    python benchmarks/bench_api.py tiles --export-format pdf --export-concurrency 4
+    python benchmarks/bench_api.py points --bbox -53.3 -19.5 -45.9 -12.4
+
+Point API_URL and API_KEY at a running deployment (see example.env). When
+measuring exports, run the API with EXPORT_CACHE_MAX_BYTES=0 so every request
+renders instead of being served from the export cache.
+"""
+import os
+import time
+import random
+import asyncio
+import argparse
+import statistics
+
+import httpx
+
+API_URL = os.getenv("API_URL", "http://localhost:8000/api")
+API_KEY = os.getenv("API_KEY_FRONTEND", "apikey123")
+API_KEY_QUERY_NAME = os.getenv("API_KEY_QUERY_NAME", "API_KEY")
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def report(name, latencies, elapsed, errors):
+    print(
+        f"{name}: {len(latencies)} ok, {errors} errors, "
+        f"{len(latencies) / elapsed:.1f} req/s, "
+        f"p50={percentile(latencies, 50) * 1000:.1f}ms "
+        f"p95={percentile(latencies, 95) * 1000:.1f}ms "
+        f"p99={percentile(latencies, 99) * 1000:.1f}ms "
+        f"mean={statistics.mean(latencies) * 1000:.1f}ms"
+    )
+
+
+async def get_token(client):
+    response = await client.get(f"{API_URL}/get-token", params={API_KEY_QUERY_NAME: API_KEY})
+    response.raise_for_status()
+    return response.json()["token"]
+
+
+async def run_load(client, make_request, total, concurrency):
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            i = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                response = await make_request(client, i)
+                if response.status_code >= 400:
+                    errors += 1
+                    continue
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, time.perf_counter() - start, errors
+
+
+async def bench_layers(args):
+    async with httpx.AsyncClient(timeout=args.timeout) as client:
+        token = await get_token(client)
+
+        async def make_request(client, i):
+            return await client.get(
+                f"{API_URL}/layers/{args.car_code}.{args.format}",
+                params={"token": token}
+            )
+
+        latencies, elapsed, errors = await run_load(client, make_request, args.requests, args.concurrency)
+        report(f"/layers/{{car_code}}.{args.format}", latencies, elapsed, errors)
+
+
+async def bench_tiles(args):
+    """Tile latency alone, then again while exports render in the background."""
+    async with httpx.AsyncClient(timeout=args.timeout) as client:
+        token = await get_token(client)
+        tiles = [
+            (args.zoom, args.x + dx, args.y + dy)
+            for dx in range(-2, 3)
+            for dy in range(-2, 3)
+        ]
+
+        async def make_request(client, i):
+            z, x, y = tiles[i % len(tiles)]
+            return await client.get(f"{API_URL}/tiles/{z}/{x}/{y}.pbf", params={"token": token})
+
+        latencies, elapsed, errors = await run_load(client, make_request, args.requests, args.concurrency)
+        report("/tiles idle", latencies, elapsed, errors)
+
+        if not args.export_format:
+            return
+
+        async def make_export_request(client, i):
+            return await client.get(
+                f"{API_URL}/layers/{args.car_code}.{args.export_format}",
+                params={"token": token}
+            )
+
+        exports = asyncio.ensure_future(
+            run_load(client, make_export_request, args.export_requests, args.export_concurrency)
+        )
+        latencies, elapsed, errors = await run_load(client, make_request, args.requests, args.concurrency)
+        report(f"/tiles while rendering {args.export_format}", latencies, elapsed, errors)
+        latencies, elapsed, errors = await exports
+        if latencies:
+            report(f"/layers/{{car_code}}.{args.export_format}", latencies, elapsed, errors)
+
+
+async def bench_points(args):
+    """Point lookups at random locations inside a bbox.
+
+    Compare p99 against a database whose car_statistics rows have no extents
+    (or an API from before the state routing) to see the partition pruning.
+    """
+    xmin, ymin, xmax, ymax = args.bbox
+    rng = random.Random(args.seed)
+    points = [
+        {"longitude": rng.uniform(xmin, xmax), "latitude": rng.uniform(ymin, ymax)}
+        for _ in range(args.requests)
+    ]
+
+    async with httpx.AsyncClient(timeout=args.timeout) as client:
+        token = await get_token(client)
+
+        async def make_request(client, i):
+            return await client.post(
+                f"{API_URL}/intersecting-perimeters",
+                params={"token": token},
+                json=points[i]
+            )
+
+        latencies, elapsed, errors = await run_load(client, make_request, args.requests, args.concurrency)
+        report("/intersecting-perimeters", latencies, elapsed, errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=60)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    layers = subparsers.add_parser("layers", help="GET /layers/{car_code}.{format}")
+    layers.add_argument("--car-code", default=os.getenv("DEFAULT_CAR_CODE"))
+    layers.add_argument("--format", default="geojson")
+    layers.set_defaults(func=bench_layers)
+
+    tiles = subparsers.add_parser("tiles", help="GET /tiles/{z}/{x}/{y}.pbf, optionally under export load")
+    tiles.add_argument("--zoom", type=int, default=12)
+    tiles.add_argument("--x", type=int, default=1458)
+    tiles.add_argument("--y", type=int, default=2240)
+    tiles.add_argument("--car-code", default=os.getenv("DEFAULT_CAR_CODE"))
+    tiles.add_argument("--export-format", choices=["pdf", "kmz", "shp"])
+    tiles.add_argument("--export-requests", type=int, default=40)
+    tiles.add_argument("--export-concurrency", type=int, default=4)
+    tiles.set_defaults(func=bench_tiles)
+
+    points = subparsers.add_parser("points", help="POST /intersecting-perimeters at random points")
+    points.add_argument(
+        "--bbox", type=float, nargs=4, metavar=("XMIN", "YMIN", "XMAX", "YMAX"),
+        default=[-73.99, -33.75, -34.79, 5.27]
+    )
+    points.add_argument("--seed", type=int, default=0)
+    points.set_defaults(func=bench_points)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""Load throughput of the ETL, execute_values INSERT batches against binary COPY.
+
+Loads the same synthetic features into a scratch table both ways and prints
+rows/s, e.g.
+
+    python benchmarks/bench_etl_load.py --features 200000
+
+Uses the POSTGRES_* settings of example.env; the database needs PostGIS.
+The scratch table bench_etl_load is dropped afterwards.
+"""
+import os
+import sys
+import json
+import time
+import struct
+import hashlib
+import argparse
+
+import psycopg2
+
+from psycopg2 import sql
+from psycopg2.extras import Json, execute_values
+from uuid_extensions import uuid7str
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "etl"))
+
+from copy_loader import CopyLoader
+
+TABLE_NAME = "bench_etl_load"
+RELEASE_DATE = "2024-01-01"
+STATE = "GO"
+
+
+def connect_db():
+    return psycopg2.connect(
+        dbname=os.getenv("POSTGRES_DB", "car"),
+        user=os.getenv("POSTGRES_USER", "postgres"),
+        password=os.getenv("POSTGRES_PASSWORD", "postgres"),
+        host=os.getenv("POSTGRES_HOST", "localhost"),
+        port=os.getenv("POSTGRES_PORT", "5432")
+    )
+
+
+def polygon_wkb(x, y, vertices):
+    """Little endian WKB polygon shaped roughly like a rural property."""
+    ring = [(x + 0.01 * (i % 2), y + 0.01 * (i // 2 % 2)) for i in range(vertices - 1)]
+    ring.append(ring[0])
+    return (
+        struct.pack("<BIII", 1, 3, 1, len(ring))
+        + b"".join(struct.pack("<dd", *point) for point in ring)
+    )
+
+
+def make_features(count, vertices):
+    """Features in the shape process_geometry yields."""
+    features = []
+    for i in range(count):
+        wkb = polygon_wkb(-50 + (i % 1000) * 0.01, -15 + (i // 1000) * 0.01, vertices)
+        properties = {
+            "cod_imovel": f"GO-5200134-{i:032X}",
+            "num_area": 100.0 + i % 500,
+            "ind_status": "AT",
+            "des_condic": "Aguardando analise",
+        }
+        properties_str = json.dumps(properties, sort_keys=True).encode("utf-8")
+        geom_hash = hashlib.md5(wkb).hexdigest()
+        properties_hash = hashlib.md5(properties_str).hexdigest()
+        features.append({
+            "geometry": wkb,
+            "properties": properties,
+            "properties_json": properties_str,
+            "hash": hashlib.md5(f"{geom_hash}-{properties_hash}".encode("utf-8")).hexdigest(),
+            "geom_hash": geom_hash,
+            "properties_hash": properties_hash,
+        })
+    return features
+
+
+def create_table():
+    conn = connect_db()
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("""
+            DROP TABLE IF EXISTS {table};
+            CREATE TABLE {table} (
+                id UUID,
+                car_code TEXT,
+                state_code VARCHAR(2),
+                release_date DATE,
+                created_at DATE DEFAULT CURRENT_DATE,
+                feature_hash UUID,
+                geom_hash UUID,
+                properties_hash UUID,
+                geom geometry(geometry, 4326),
+                properties JSONB,
+                PRIMARY KEY (id, state_code)
+            );
+        """).format(table=sql.Identifier(TABLE_NAME)))
+    conn.commit()
+    conn.close()
+
+
+def drop_table():
+    conn = connect_db()
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("DROP TABLE IF EXISTS {table};").format(table=sql.Identifier(TABLE_NAME)))
+    conn.commit()
+    conn.close()
+
+
+def load_execute_values(features, batch_size):
+    """The former insert_data_batch: a connection and a VALUES insert per batch."""
+    for start in range(0, len(features), batch_size):
+        conn = connect_db()
+        cursor = conn.cursor()
+        records = [
+            (
+                uuid7str(),
+                feature["properties"]["cod_imovel"],
+                STATE,
+                RELEASE_DATE,
+                feature["hash"],
+                feature["geom_hash"],
+                feature["properties_hash"],
+                # ST_SetSRID in the template, bare WKB has no SRID for the 4326 column
+                psycopg2.Binary(feature["geometry"]),
+                Json(feature["properties"])
+            )
+            for feature in features[start:start + batch_size]
+        ]
+        insert_query = sql.SQL("""
+            INSERT INTO {table} (
+                id, car_code, state_code, release_date,
+                feature_hash, geom_hash, properties_hash, geom, properties)
+            VALUES %s
+        """).format(table=sql.Identifier(TABLE_NAME))
+        execute_values(
+            cursor,
+            insert_query.as_string(conn),
+            records,
+            template="(%s, %s, %s, %s, %s, %s, %s, ST_SetSRID(ST_GeomFromWKB(%s), 4326), %s)"
+        )
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+
+def load_copy(features, max_buffer_bytes):
+    conn = connect_db()
+    loader = CopyLoader(conn, TABLE_NAME, STATE, RELEASE_DATE, max_buffer_bytes)
+    try:
+        for feature in features:
+            loader.write(feature)
+        loader.close()
+    except BaseException:
+        loader.abort()
+        raise
+    finally:
+        conn.close()
+
+
+def bench(name, load, features):
+    create_table()
+    start = time.perf_counter()
+    load(features)
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {len(features)} rows in {elapsed:.1f}s, {len(features) / elapsed:,.0f} rows/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--features", type=int, default=100000)
+    parser.add_argument("--vertices", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=100, help="MAX_BATCH_SIZE of the INSERT path")
+    parser.add_argument("--buffer-mb", type=int, default=64, help="COPY back-pressure buffer")
+    args = parser.parse_args()
+
+    features = make_features(args.features, args.vertices)
+    try:
+        bench("execute_values", lambda features: load_execute_values(features, args.batch_size), features)
+        bench("binary COPY", lambda features: load_copy(features, args.buffer_mb * 1024 * 1024), features)
+    finally:
+        drop_table()
+
+
+if __name__ == "__main__":
+    main()
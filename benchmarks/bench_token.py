@@ -0,0 +1,63 @@
+"""Token verification throughput, full jwt.decode against the token cache.
+
+Runs in process, no API needed:
+
+    python benchmarks/bench_token.py --iterations 200000
+"""
+import os
+import sys
+import time
+import argparse
+
+from datetime import datetime, timedelta, timezone
+
+import jwt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "api"))
+
+from token_cache import TokenCache
+
+SECRET = "benchmark-secret-benchmark-secret-0123"
+
+
+def make_token():
+    expire = datetime.now(tz=timezone.utc) + timedelta(hours=1)
+    return jwt.encode({"sub": "tiles_access", "exp": expire}, SECRET, algorithm="HS256")
+
+
+def bench(name, verify, token, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        verify(token)
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {iterations / elapsed:,.0f} verifications/s, {elapsed / iterations * 1e6:.2f}us each")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    token = make_token()
+    token_cache = TokenCache()
+
+    def decode(token):
+        payload = jwt.decode(token, SECRET, algorithms=["HS256"])
+        return payload["sub"] == "tiles_access"
+
+    def cached(token):
+        # Same steps as verify_token_from_query on a cache hit
+        key = token_cache.make_key(token)
+        expires_at = token_cache.get(key)
+        if expires_at is not None and time.time() < expires_at:
+            return True
+        payload = jwt.decode(token, SECRET, algorithms=["HS256"])
+        token_cache.put(key, payload["exp"])
+        return payload["sub"] == "tiles_access"
+
+    bench("jwt.decode", decode, token, args.iterations)
+    bench("token cache", cached, token, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import os
+import time
+import asyncio
+
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import asyncpg
+
+# Statements kept per connection besides the ones prepared by the pool init
+STATEMENT_CACHE_SIZE = int(os.getenv("STATEMENT_CACHE_SIZE", "256"))
+# A connection checked out for longer than this is reported as a likely leak
+POOL_LEAK_SECONDS = float(os.getenv("POOL_LEAK_SECONDS", "120"))
+POOL_LEAK_CHECK_SECONDS = float(os.getenv("POOL_LEAK_CHECK_SECONDS", "30"))
+
+
+class PreparedConnection(asyncpg.Connection):
+    """Connection that keeps its prepared statements by query text.
+
+    Statements prepared while the pool initialises the connection are pinned
+    for its whole life, any other query is kept in a small LRU so the
+    per-layer queries are parsed and planned once per connection too.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pinned_statements = {}
+        self.statements = OrderedDict()
+
+    async def prepared(self, query, pin=False):
+        statement = self.pinned_statements.get(query)
+        if statement is not None:
+            return statement
+        statement = self.statements.get(query)
+        if statement is not None:
+            self.statements.move_to_end(query)
+            return statement
+
+        statement = await self.prepare(query)
+        if pin:
+            self.pinned_statements[query] = statement
+        else:
+            self.statements[query] = statement
+            if len(self.statements) > STATEMENT_CACHE_SIZE:
+                # Dropped statements are deallocated by asyncpg once unreferenced
+                self.statements.popitem(last=False)
+        return statement
+
+
+class MonitoredPool:
+    """asyncpg pool opened at startup that accounts for every checkout.
+
+    Records how long requests wait for a connection and how long they hold
+    it, and a background task reports connections held past
+    POOL_LEAK_SECONDS, e.g. a stream whose client stopped reading.
+    """
+
+    def __init__(self, connect_kwargs, min_size, max_size, acquire_timeout=None):
+        self.connect_kwargs = connect_kwargs
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.hot_queries = []
+        self.pool = None
+        self.leak_task = None
+        self.held = {}
+        self.acquisitions = 0
+        self.acquire_timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.leaks = 0
+
+    async def open(self, hot_queries=()):
+        """Open min_size connections, each with `hot_queries` already prepared."""
+        self.hot_queries = list(hot_queries)
+        self.pool = await asyncpg.create_pool(
+            **self.connect_kwargs,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            connection_class=PreparedConnection,
+            init=self.init_connection
+        )
+        self.leak_task = asyncio.ensure_future(self.check_leaks())
+        print(f"Database pool open, {self.min_size} to {self.max_size} connections")
+
+    async def close(self):
+        if self.leak_task is not None:
+            self.leak_task.cancel()
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def init_connection(self, conn):
+        for query in self.hot_queries:
+            try:
+                await conn.prepared(query, pin=True)
+            except asyncpg.UndefinedTableError:
+                # ETL has not loaded the table yet, prepare on first use
+                pass
+
+    async def acquire(self, label):
+        start = time.monotonic()
+        try:
+            conn = await self.pool.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.acquire_timeouts += 1
+            raise
+        now = time.monotonic()
+        waited = now - start
+        self.acquisitions += 1
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        self.held[conn] = [now, label, False]
+        return conn
+
+    async def release(self, conn):
+        self.held.pop(conn, None)
+        await self.pool.release(conn)
+
+    @asynccontextmanager
+    async def connection(self, label):
+        conn = await self.acquire(label)
+        try:
+            yield conn
+        finally:
+            await self.release(conn)
+
+    async def check_leaks(self):
+        while True:
+            await asyncio.sleep(POOL_LEAK_CHECK_SECONDS)
+            now = time.monotonic()
+            for held in list(self.held.values()):
+                acquired_at, label, reported = held
+                if not reported and now - acquired_at > POOL_LEAK_SECONDS:
+                    held[2] = True
+                    self.leaks += 1
+                    print(f"Connection held for {now - acquired_at:.0f}s by {label}, possible leak")
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "pid": os.getpid(),
+            "size": self.pool.get_size() if self.pool else 0,
+            "idle": self.pool.get_idle_size() if self.pool else 0,
+            "in_use": len(self.held),
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "acquisitions": self.acquisitions,
+            "acquire_timeouts": self.acquire_timeouts,
+            "mean_wait_ms": 1000 * self.wait_seconds / self.acquisitions if self.acquisitions else None,
+            "max_wait_ms": 1000 * self.max_wait_seconds,
+            "longest_held_seconds": max((now - held[0] for held in self.held.values()), default=0.0),
+            "held_over_threshold": sum(1 for held in self.held.values() if now - held[0] > POOL_LEAK_SECONDS),
+            "leaks_reported": self.leaks,
+        }
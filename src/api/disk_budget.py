@@ -0,0 +1,69 @@
+import os
+import fcntl
+import struct
+
+
+class DiskBudget:
+    """Size counter and LRU eviction for a cache directory shared by workers.
+
+    The total size of the entries is kept in a counter file updated under
+    flock, so writers only scan the directory once it goes over `max_bytes`.
+    `entries` is a callable yielding (path, size, mtime) for every entry;
+    eviction removes the oldest mtimes down to `low_watermark` of the
+    budget, so it does not run again on the next write.
+    """
+
+    def __init__(self, size_path, max_bytes, low_watermark, entries):
+        self.size_path = size_path
+        self.max_bytes = max_bytes
+        self.low_watermark = low_watermark
+        self.entries = entries
+        self.evictions = 0
+
+    def read_size(self):
+        """Last size recorded in the counter file, None before the first write."""
+        try:
+            with open(self.size_path, "rb") as file:
+                counter = file.read(8)
+        except FileNotFoundError:
+            return None
+        return struct.unpack("<q", counter)[0] if len(counter) == 8 else None
+
+    def add_bytes(self, delta):
+        """Account `delta` bytes in the counter, evicting when over budget."""
+        fd = os.open(self.size_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            counter = os.pread(fd, 8, 0)
+            if len(counter) == 8:
+                total_bytes = struct.unpack("<q", counter)[0] + delta
+            else:
+                # New counter file, the write being accounted is already on disk
+                total_bytes = sum(size for _, size, _ in self.entries())
+            if total_bytes > self.max_bytes:
+                total_bytes = self.evict()
+            os.pwrite(fd, struct.pack("<q", max(total_bytes, 0)), 0)
+        finally:
+            os.close(fd)
+
+    def evict(self):
+        """Remove the least recently used entries, returning the size left.
+
+        Called with the counter file locked. The scan also corrects the
+        counter for entries other processes raced on or removed.
+        """
+        entries = list(self.entries())
+        total_bytes = sum(size for _, size, _ in entries)
+        if total_bytes <= self.max_bytes:
+            return total_bytes
+        target_bytes = self.max_bytes * self.low_watermark
+        for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+            if total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            self.evictions += 1
+        return total_bytes
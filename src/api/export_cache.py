@@ -0,0 +1,112 @@
+import os
+import asyncio
+import hashlib
+import tempfile
+
+from disk_budget import DiskBudget
+
+EXPORT_CACHE_DIR = os.getenv("EXPORT_CACHE_DIR", "/tmp/car_export_cache")
+EXPORT_CACHE_MAX_BYTES = int(os.getenv("EXPORT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Evict down to this fraction of the budget so eviction does not run on every write
+EXPORT_CACHE_LOW_WATERMARK = float(os.getenv("EXPORT_CACHE_LOW_WATERMARK", "0.9"))
+
+
+class ExportCache:
+    """Disk cache of rendered exports shared by every worker on the host.
+
+    Entries are content-addressed by car_code, format, layer filter and the
+    release of the layers involved, so a new release never serves a stale
+    file and nothing has to be invalidated. Reads bump the file mtime and
+    writes evict the least recently used files once the directory grows over
+    `max_bytes`, tracked by a DiskBudget so the directory is only scanned
+    when it is over budget. Disk work runs in threads, off the event loop.
+    """
+
+    def __init__(self, cache_dir=EXPORT_CACHE_DIR, max_bytes=EXPORT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.budget = DiskBudget(
+            os.path.join(cache_dir, ".size"),
+            max_bytes,
+            EXPORT_CACHE_LOW_WATERMARK,
+            self.entries
+        )
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(car_code, file_format, layer, release_key):
+        raw = f"{car_code}|{file_format}|{layer or ''}|{release_key}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    async def get(self, key):
+        data = await asyncio.to_thread(self.read_entry, self.path_for(key))
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    @staticmethod
+    def read_entry(path):
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            # Bump the mtime, eviction drops the least recently used exports
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    async def put(self, key, data):
+        await asyncio.to_thread(self.write_entry, self.path_for(key), data)
+        self.writes += 1
+
+    def write_entry(self, path, data):
+        # Write to a private temp file and rename, so concurrent workers
+        # never read a partially written export
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            try:
+                replaced_bytes = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced_bytes = 0
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        self.budget.add_bytes(len(data) - replaced_bytes)
+
+    def entries(self):
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith("."):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            yield entry.path, stat.st_size, stat.st_mtime
+
+    def stats(self):
+        # The counter file, scanning the directory here would block the loop
+        lookups = self.hits + self.misses
+        return {
+            "pid": os.getpid(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "writes": self.writes,
+            "evictions": self.budget.evictions,
+            "size_bytes": self.budget.read_size(),
+            "max_bytes": self.max_bytes,
+        }
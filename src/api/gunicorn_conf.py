@@ -7,3 +7,9 @@ bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
 loglevel = os.getenv("GUNICORN_LOGLEVEL", "info")
 accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-")  # Default to stdout
 errorlog = os.getenv("GUNICORN_ERROR_LOG", "-")  # Default to stderr
+
+
+def on_starting(server):
+    # Workers size their database pool from GUNICORN_WORKERS, export the
+    # worker count gunicorn resolved (env, default or -w) before forking them
+    os.environ["GUNICORN_WORKERS"] = str(server.cfg.workers)
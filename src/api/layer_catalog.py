@@ -0,0 +1,207 @@
+import os
+import json
+import asyncio
+import hashlib
+
+from collections import defaultdict
+
+import asyncpg
+
+CATALOG_CHANNEL = os.getenv("CATALOG_CHANNEL", "car_catalog")
+CATALOG_RECONNECT_SECONDS = int(os.getenv("CATALOG_RECONNECT_SECONDS", "5"))
+
+CATALOG_QUERY = """
+    SELECT DISTINCT ON (state_code, layer)
+        state_code, layer, release_date, count_active_features, created_at,
+        xmin, ymin, xmax, ymax
+    FROM car_statistics
+    ORDER BY state_code, layer, release_date DESC
+"""
+
+# car_statistics written before the ETL stored partition extents
+LEGACY_CATALOG_QUERY = """
+    SELECT DISTINCT ON (state_code, layer)
+        state_code, layer, release_date, count_active_features, created_at
+    FROM car_statistics
+    ORDER BY state_code, layer, release_date DESC
+"""
+
+
+class LayerCatalog:
+    """In-process copy of the latest car_statistics row per state and layer.
+
+    Loaded once when the worker starts and reloaded only when the ETL sends a
+    NOTIFY on CATALOG_CHANNEL, so request handlers never query it.
+    """
+
+    def __init__(self, connect_kwargs):
+        self.connect_kwargs = connect_kwargs
+        self.layers = {}
+        self.state_layers = {}
+        self.layer_versions = {}
+        self.extents = {}
+        self.body = b"{}"
+        self.version = ""
+        self.listener_conn = None
+        self.refresh_lock = asyncio.Lock()
+        self.refresh_task = None
+        self.refresh_pending = False
+        self.tasks = set()
+        self.closed = False
+
+    async def start(self):
+        await self.listen()
+        await self.refresh()
+
+    async def close(self):
+        self.closed = True
+        for task in list(self.tasks):
+            task.cancel()
+        if self.listener_conn is not None and not self.listener_conn.is_closed():
+            await self.listener_conn.close()
+        self.listener_conn = None
+
+    async def listen(self):
+        self.listener_conn = await asyncpg.connect(**self.connect_kwargs)
+        await self.listener_conn.add_listener(CATALOG_CHANNEL, self.on_notify)
+        self.listener_conn.add_termination_listener(self.on_terminate)
+
+    def on_notify(self, conn, pid, channel, payload):
+        print(f"Catalog change notified ({payload}), refreshing")
+        self.request_refresh()
+
+    def on_terminate(self, conn):
+        if not self.closed:
+            self.spawn(self.reconnect())
+
+    def spawn(self, coro):
+        # The loop only keeps weak references to tasks
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+        return task
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Catalog task failed: {task.exception()!r}")
+
+    def request_refresh(self):
+        """Refresh in the background, one run for any number of notifications.
+
+        Notifications arriving while a refresh runs only mark the catalog as
+        stale, the running task reloads it once more when it finishes.
+        """
+        self.refresh_pending = True
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = self.spawn(self.refresh_while_pending())
+
+    async def refresh_while_pending(self):
+        while self.refresh_pending and not self.closed:
+            self.refresh_pending = False
+            await self.refresh()
+
+    async def reconnect(self):
+        while not self.closed:
+            try:
+                await self.listen()
+                # Anything written while we were disconnected was not notified
+                await self.refresh()
+                return
+            except Exception as e:
+                print(f"Catalog listener reconnect failed: {e}")
+                await asyncio.sleep(CATALOG_RECONNECT_SECONDS)
+
+    async def refresh(self):
+        async with self.refresh_lock:
+            try:
+                results = await self.listener_conn.fetch(CATALOG_QUERY)
+            except asyncpg.UndefinedColumnError:
+                results = await self.listener_conn.fetch(LEGACY_CATALOG_QUERY)
+            except asyncpg.UndefinedTableError:
+                # ETL has not created car_statistics yet
+                results = []
+
+            layers = defaultdict(dict)
+            for record in results:
+                layers[record["state_code"]][record["layer"]] = {
+                    "release_date": record["release_date"].isoformat(),
+                    "feature_count": record["count_active_features"],
+                    "download_date": record["created_at"].isoformat(),
+                }
+
+            body = json.dumps(layers, separators=(",", ":")).encode("utf-8")
+            self.layers = dict(layers)
+            self.state_layers = {
+                state_code: {layer.upper(): layer for layer in state_layers}
+                for state_code, state_layers in layers.items()
+            }
+            self.layer_versions = self.build_layer_versions(layers)
+            self.extents = self.build_extents(results)
+            self.body = body
+            self.version = hashlib.md5(body).hexdigest()
+
+    @staticmethod
+    def build_layer_versions(layers):
+        """Digest of every state's release date, per lower case layer table."""
+        releases = defaultdict(list)
+        for state_code, state_layers in sorted(layers.items()):
+            for layer_name, layer in state_layers.items():
+                releases[layer_name.lower()].append(f"{state_code}={layer['release_date']}")
+        return {
+            table_name: hashlib.md5(",".join(table_releases).encode("utf-8")).hexdigest()[:16]
+            for table_name, table_releases in releases.items()
+        }
+
+    @staticmethod
+    def build_extents(results):
+        """Partition extents per lower case layer table, None for a state without one."""
+        extents = defaultdict(list)
+        for record in results:
+            extent = tuple(record.get(column) for column in ("xmin", "ymin", "xmax", "ymax"))
+            extents[record["layer"].lower()].append(
+                (record["state_code"], None if None in extent else extent)
+            )
+        return dict(extents)
+
+    def candidate_states(self, table_name, xmin, ymin, xmax=None, ymax=None):
+        """Return the states whose `table_name` partition may hold a point or bbox.
+
+        Returns None when some partition has no stored extent, in which case
+        every partition has to be searched.
+        """
+        if xmax is None:
+            xmax, ymax = xmin, ymin
+        states = []
+        for state_code, extent in self.extents.get(table_name, []):
+            if extent is None:
+                return None
+            state_xmin, state_ymin, state_xmax, state_ymax = extent
+            if xmin <= state_xmax and xmax >= state_xmin and ymin <= state_ymax and ymax >= state_ymin:
+                states.append(state_code)
+        return states
+
+    def layer_names(self, state_code, layer=None):
+        state_layers = self.state_layers.get(state_code.upper(), {})
+        if layer is not None:
+            layer_name = state_layers.get(layer.upper())
+            return [layer_name] if layer_name else []
+        return list(state_layers.values())
+
+    def table_names(self, state_code, layer=None):
+        """Return the `{layer}_{state}` partitions available for a state.
+
+        When `layer` is given only that partition is returned, if it exists.
+        """
+        return [
+            f"{layer_name.lower()}_{state_code.lower()}"
+            for layer_name in self.layer_names(state_code, layer)
+        ]
+
+    def release_key(self, state_code, layer=None):
+        """Identify the releases behind a state's layers, e.g. for cache keys."""
+        state_layers = self.layers.get(state_code.upper(), {})
+        return ",".join(
+            f"{layer_name}={state_layers[layer_name]['release_date']}"
+            for layer_name in sorted(self.layer_names(state_code, layer))
+        )
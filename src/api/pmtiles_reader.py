@@ -0,0 +1,195 @@
+import os
+import gzip
+import mmap
+import struct
+
+from collections import OrderedDict
+
+PMTILES_LEAF_CACHE_SIZE = int(os.getenv("PMTILES_LEAF_CACHE_SIZE", "256"))
+
+# PMTiles v3 fixed size header, little endian
+HEADER_FORMAT = "<7sB11Q6B4iB2i"
+HEADER_SIZE = 127
+
+COMPRESSION_NONE = 1
+COMPRESSION_GZIP = 2
+CONTENT_ENCODINGS = {2: "gzip", 3: "br", 4: "zstd"}
+
+# Root, then at most three levels of leaf directories (spec limit)
+MAX_DIRECTORY_DEPTH = 4
+
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def rotate(n, x, y, rx, ry):
+    if ry == 0:
+        if rx != 0:
+            x = n - 1 - x
+            y = n - 1 - y
+        return y, x
+    return x, y
+
+
+def zxy_to_tileid(z, x, y):
+    """Position of a tile on the PMTiles Hilbert curve."""
+    if x >= 1 << z or y >= 1 << z:
+        raise ValueError("tile x/y outside zoom level")
+    tile_id = ((1 << (z * 2)) - 1) // 3
+    for a in range(z - 1, -1, -1):
+        s = 1 << a
+        rx = s & x
+        ry = s & y
+        tile_id += ((3 * rx) ^ ry) << a
+        x, y = rotate(s, x, y, rx, ry)
+    return tile_id
+
+
+def deserialize_directory(buf):
+    """Decode a directory into parallel lists of tile_id, run_length, offset, length."""
+    count, pos = read_varint(buf, 0)
+    tile_ids = [0] * count
+    run_lengths = [0] * count
+    lengths = [0] * count
+    offsets = [0] * count
+
+    last_id = 0
+    for i in range(count):
+        delta, pos = read_varint(buf, pos)
+        last_id += delta
+        tile_ids[i] = last_id
+    for i in range(count):
+        run_lengths[i], pos = read_varint(buf, pos)
+    for i in range(count):
+        lengths[i], pos = read_varint(buf, pos)
+    for i in range(count):
+        value, pos = read_varint(buf, pos)
+        # Zero means the entry directly follows the previous one
+        if value == 0 and i > 0:
+            offsets[i] = offsets[i - 1] + lengths[i - 1]
+        else:
+            offsets[i] = value - 1
+    return tile_ids, run_lengths, offsets, lengths
+
+
+def find_entry(directory, tile_id):
+    """Index of the entry holding tile_id, or of the leaf directory that may hold it."""
+    tile_ids, run_lengths, _, _ = directory
+    low, high = 0, len(tile_ids) - 1
+    while low <= high:
+        middle = (low + high) >> 1
+        if tile_id > tile_ids[middle]:
+            low = middle + 1
+        elif tile_id < tile_ids[middle]:
+            high = middle - 1
+        else:
+            return middle
+    if high >= 0:
+        # Leaf directory pointer, or a run of identical tiles covering tile_id
+        if run_lengths[high] == 0 or tile_id - tile_ids[high] < run_lengths[high]:
+            return high
+    return None
+
+
+class PMTilesArchive:
+    """Read tiles from a local PMTiles v3 archive through a memory map.
+
+    The header and root directory are decoded when the archive is opened and
+    leaf directories are kept in a small LRU. Tiles are returned as
+    memoryviews over the map, in the archive's own compression.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        stat = os.fstat(self.file.fileno())
+        # Changes whenever the archive file is replaced
+        self.version = f"{stat.st_ino:x}-{stat.st_mtime_ns:x}"
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self.mmap)
+
+        (
+            magic, spec_version,
+            root_offset, root_length,
+            metadata_offset, metadata_length,
+            leaf_offset, leaf_length,
+            tile_data_offset, tile_data_length,
+            addressed_tiles, tile_entries, tile_contents,
+            clustered, internal_compression, tile_compression, tile_type,
+            min_zoom, max_zoom,
+            min_lon_e7, min_lat_e7, max_lon_e7, max_lat_e7,
+            center_zoom, center_lon_e7, center_lat_e7,
+        ) = struct.unpack_from(HEADER_FORMAT, self.mmap, 0)
+
+        if magic != b"PMTiles" or spec_version != 3:
+            raise ValueError(f"{path} is not a PMTiles v3 archive")
+        if internal_compression not in (COMPRESSION_NONE, COMPRESSION_GZIP):
+            raise ValueError(f"Unsupported PMTiles directory compression {internal_compression}")
+
+        self.internal_compression = internal_compression
+        self.content_encoding = CONTENT_ENCODINGS.get(tile_compression)
+        self.tile_type = tile_type
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.leaf_offset = leaf_offset
+        self.tile_data_offset = tile_data_offset
+        self.root_directory = self.read_directory(root_offset, root_length)
+        self.leaf_directories = OrderedDict()
+
+    def read_directory(self, offset, length):
+        data = self.buffer[offset:offset + length]
+        if self.internal_compression == COMPRESSION_GZIP:
+            data = gzip.decompress(data)
+        return deserialize_directory(data)
+
+    def leaf_directory(self, offset, length):
+        key = (offset, length)
+        directory = self.leaf_directories.get(key)
+        if directory is not None:
+            self.leaf_directories.move_to_end(key)
+            return directory
+        directory = self.read_directory(self.leaf_offset + offset, length)
+        self.leaf_directories[key] = directory
+        if len(self.leaf_directories) > PMTILES_LEAF_CACHE_SIZE:
+            self.leaf_directories.popitem(last=False)
+        return directory
+
+    def get_tile(self, z, x, y):
+        """Tile bytes as a zero-copy memoryview, or None if the tile is empty."""
+        if z < self.min_zoom or z > self.max_zoom:
+            return None
+        try:
+            tile_id = zxy_to_tileid(z, x, y)
+        except ValueError:
+            return None
+
+        directory = self.root_directory
+        for _ in range(MAX_DIRECTORY_DEPTH):
+            index = find_entry(directory, tile_id)
+            if index is None:
+                return None
+            _, run_lengths, offsets, lengths = directory
+            if run_lengths[index] > 0:
+                start = self.tile_data_offset + offsets[index]
+                return self.buffer[start:start + lengths[index]]
+            directory = self.leaf_directory(offsets[index], lengths[index])
+        return None
+
+    def close(self):
+        self.file.close()
+        try:
+            self.buffer.release()
+            self.mmap.close()
+        except BufferError:
+            # Tiles still being sent hold views on the map, which is then
+            # unmapped once the last of them is garbage collected
+            pass
@@ -1,131 +1,263 @@
 
-import os
-import json
+import html
+import uuid
+from functools import lru_cache
 from osgeo import ogr, osr, gdal
-import matplotlib.colors as mcolors
-import simplekml
 from datetime import datetime
-import tempfile
 import zipfile
 from io import BytesIO
 
-def create_shapefile_from_geojson(geojson: dict, car_code: str) -> bytes:
+def warm_up_renderer():
+    """Load the GDAL drivers used by exports, run once per render process."""
+    for driver_name in ["PDF", "ESRI Shapefile", "Memory"]:
+        gdal.GetDriverByName(driver_name)
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        geojson_path = os.path.join(tmpdir, f"{car_code}.geojson")
-        shp_path = os.path.join(tmpdir, f"{car_code}.shp")
+def vsimem_dir():
+    """Private /vsimem folder so concurrent renders never share files."""
+    return f"/vsimem/{uuid.uuid4().hex}"
 
-        with open(geojson_path, 'w', encoding='utf-8') as f:
-            json.dump(geojson, f)
+def read_vsimem_file(path):
+    stat = gdal.VSIStatL(path)
+    if stat is None:
+        return None
+    vsi_file = gdal.VSIFOpenL(path, "rb")
+    try:
+        return gdal.VSIFReadL(1, stat.size, vsi_file)
+    finally:
+        gdal.VSIFCloseL(vsi_file)
+
+def remove_vsimem_dir(path):
+    for name in gdal.ReadDir(path) or []:
+        gdal.Unlink(f"{path}/{name}")
+    gdal.Rmdir(path)
+
+def ogr_field_type(value):
+    if isinstance(value, int):
+        return ogr.OFTInteger64
+    if isinstance(value, float):
+        return ogr.OFTReal
+    return ogr.OFTString
+
+def properties_field_types(features):
+    """OGR field type per property name, in first seen order.
+
+    Mixed integer/real columns become real, any other mix becomes string,
+    like the GeoJSON driver would infer them.
+    """
+    field_types = {}
+    for _, properties in features:
+        for name, value in properties.items():
+            if value is None:
+                field_types.setdefault(name, None)
+                continue
+            value_type = ogr_field_type(value)
+            current_type = field_types.get(name)
+            if current_type is None or current_type == value_type:
+                field_types[name] = value_type
+            elif {current_type, value_type} == {ogr.OFTInteger64, ogr.OFTReal}:
+                field_types[name] = ogr.OFTReal
+            else:
+                field_types[name] = ogr.OFTString
+    return {name: field_type or ogr.OFTString for name, field_type in field_types.items()}
+
+def create_memory_dataset(features, layer_name):
+    """Build an in-memory OGR data source from (WKB geometry, properties) rows.
+
+    Geometries are parsed straight from the WKB sent by PostGIS, without any
+    GeoJSON encoding in between. Its single layer is only valid while the
+    data source is referenced.
+    """
+    spatialRef = osr.SpatialReference()
+    spatialRef.ImportFromEPSG(4326)
+    spatialRef.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    data_source = ogr.GetDriverByName("Memory").CreateDataSource("")
+    layer = data_source.CreateLayer(layer_name, srs=spatialRef, geom_type=ogr.wkbUnknown)
+
+    field_types = properties_field_types(features)
+    for name, field_type in field_types.items():
+        layer.CreateField(ogr.FieldDefn(name, field_type))
+
+    layer_defn = layer.GetLayerDefn()
+    for geometry_wkb, properties in features:
+        feature = ogr.Feature(layer_defn)
+        feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(geometry_wkb))
+        for name, value in properties.items():
+            if value is None:
+                continue
+            if field_types[name] == ogr.OFTString and not isinstance(value, str):
+                value = str(value)
+            feature.SetField(name, value)
+        layer.CreateFeature(feature)
+        feature = None
+    return data_source
+
+def create_shapefile_from_features(features, car_code: str) -> bytes:
+    tmpdir = vsimem_dir()
+    try:
+        shp_path = f"{tmpdir}/{car_code}.shp"
 
         drv = ogr.GetDriverByName("ESRI Shapefile")
-        if os.path.exists(shp_path):
-            drv.DeleteDataSource(shp_path)
-
         ds = drv.CreateDataSource(shp_path)
-        ogr_ds = ogr.Open(geojson_path)
-        geojson_layer = ogr_ds.GetLayer()
+        memory_ds = create_memory_dataset(features, car_code)
 
-        ds.CopyLayer(geojson_layer, geojson_layer.GetName())
+        ds.CopyLayer(memory_ds.GetLayer(0), car_code)
 
         ds = None
-        ogr_ds = None
+        memory_ds = None
 
         mem_zip = BytesIO()
         with zipfile.ZipFile(mem_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
             for ext in [".shp", ".shx", ".dbf", ".prj", ".cpg"]:
-                path = os.path.join(tmpdir, f"{car_code}{ext}")
-                if os.path.exists(path):
-                    zipf.write(path, arcname=f"{car_code}{ext}")
-        mem_zip.seek(0)
-        return mem_zip.read()
-
+                file_data = read_vsimem_file(f"{tmpdir}/{car_code}{ext}")
+                if file_data is not None:
+                    zipf.writestr(f"{car_code}{ext}", file_data)
+        return mem_zip.getvalue()
+    finally:
+        remove_vsimem_dir(tmpdir)
+
+
+STYLE_RULES = {
+    "hidrografia": {"color": "blue", "fillColor": "blue", "fillOpacity": 0.6, "opacity":0.5, "weight":0},
+    "area_imovel": {"color": "yellow", "fillColor": "white", "fillOpacity":0.1, "weight":3, "opacity":1},
+    "apps": {"color": "red", "fillColor": "red", "fillOpacity": 0.3, "opacity":0.5, "weight":0.8},
+    "reserva_legal": {"color": "green", "fillColor": "green", "fillOpacity": 0.4, "opacity":0.8, "weight":3},
+    "area_consolidada": {"color": "lightyellow", "fillColor": "lightyellow", "fillOpacity": 0.3, "opacity":0.5, "weight":0},
+    "uso_restrito": {"color": "orange", "fillColor": "orange", "fillOpacity": 0.5, "opacity":0.5, "weight":0},
+    "servidao_administrativa": {"color": "black", "fillColor": "black", "fillOpacity": 0.5, "opacity":0.5, "weight":1},
+    "area_pousio": {"color": "lightorange", "fillColor": "lightorange", "fillOpacity": 0.5, "opacity":0.5, "weight":0},
+    "vegetacao_nativa": {"color": "lightgreen", "fillColor": "lightgreen", "fillOpacity": 0.4, "opacity":0.3, "weight":3},
+    #"arl_proposta": {"color": "green", "fillColor": "green", "fillOpacity": 0.5, "opacity":0.5, "weight":0},
+}
+DEFAULT_STYLE_NAME = "default"
+DEFAULT_STYLE = {"color": "purple", "fillColor": "purple", "opacity":0.5, "fillOpacity": 0.5,}
+
+# Substring checked in cod_tema -> style rule, in priority order
+STYLE_FALLBACKS = [
+    ("app", "apps"),
+    ("arl", "reserva_legal"),
+    ("reservatorio", "hidrografia"),
+    ("rio", "hidrografia"),
+    ("servidao", "servidao_administrativa"),
+    ("publica", "servidao_administrativa"),
+    ("uso_restrito", "uso_restrito"),
+]
+
+# CSS named colors used by STYLE_RULES, as matplotlib.colors.to_hex resolved them
+NAMED_COLORS = {
+    "black": "000000",
+    "blue": "0000ff",
+    "green": "008000",
+    "lightgreen": "90ee90",
+    "lightyellow": "ffffe0",
+    "none": "000000",
+    "orange": "ffa500",
+    "purple": "800080",
+    "red": "ff0000",
+    "white": "ffffff",
+    "yellow": "ffff00",
+}
 
 def get_style_rules():
-    return {
-        "hidrografia": {"color": "blue", "fillColor": "blue", "fillOpacity": 0.6, "opacity":0.5, "weight":0},
-        "area_imovel": {"color": "yellow", "fillColor": "white", "fillOpacity":0.1, "weight":3, "opacity":1},
-        "apps": {"color": "red", "fillColor": "red", "fillOpacity": 0.3, "opacity":0.5, "weight":0.8},
-        "reserva_legal": {"color": "green", "fillColor": "green", "fillOpacity": 0.4, "opacity":0.8, "weight":3},
-        "area_consolidada": {"color": "lightyellow", "fillColor": "lightyellow", "fillOpacity": 0.3, "opacity":0.5, "weight":0},
-        "uso_restrito": {"color": "orange", "fillColor": "orange", "fillOpacity": 0.5, "opacity":0.5, "weight":0},
-        "servidao_administrativa": {"color": "black", "fillColor": "black", "fillOpacity": 0.5, "opacity":0.5, "weight":1},
-        "area_pousio": {"color": "lightorange", "fillColor": "lightorange", "fillOpacity": 0.5, "opacity":0.5, "weight":0},
-        "vegetacao_nativa": {"color": "lightgreen", "fillColor": "lightgreen", "fillOpacity": 0.4, "opacity":0.3, "weight":3},
-        #"arl_proposta": {"color": "green", "fillColor": "green", "fillOpacity": 0.5, "opacity":0.5, "weight":0},
-    }
+    return STYLE_RULES
 
 def get_style(feature):
     cod_tema = feature['properties'].get('cod_tema', '').lower()
     return get_style_cod_theme(cod_tema)
 
-def get_style_cod_theme(cod_tema):
-    style_rules = get_style_rules()
+@lru_cache(maxsize=4096)
+def classify_cod_theme(cod_tema):
+    """Name of the style rule for a cod_tema, memoized per distinct value."""
     cod_tema = str(cod_tema).lower()
-    if cod_tema in style_rules:
-        return style_rules[cod_tema]
-    if "app" in cod_tema.lower():
-        return style_rules["apps"]
-    if "arl" in cod_tema.lower():
-        return style_rules["reserva_legal"]
-    if "reservatorio" in cod_tema.lower():
-        return style_rules["hidrografia"]
-    if "rio" in cod_tema.lower():
-        return style_rules["hidrografia"]
-    if "servidao" in cod_tema.lower():
-        return style_rules["servidao_administrativa"]
-    if "publica" in cod_tema.lower():
-        return style_rules["servidao_administrativa"]
-    if "uso_restrito" in cod_tema.lower():
-        return style_rules["uso_restrito"]
-    return {"color": "purple", "fillColor": "purple", "opacity":0.5, "fillOpacity": 0.5,}
+    if cod_tema in STYLE_RULES:
+        return cod_tema
+    for pattern, style_name in STYLE_FALLBACKS:
+        if pattern in cod_tema:
+            return style_name
+    return DEFAULT_STYLE_NAME
+
+def get_style_cod_theme(cod_tema):
+    return get_compiled_style(cod_tema)["rule"]
+
+def get_compiled_style(cod_tema):
+    return STYLE_TABLE[classify_cod_theme(cod_tema)]
 
 
 def color_name_to_hex(color_name):
-    try:
-        return mcolors.to_hex(color_name)
-    except Exception:
+    hex_color = NAMED_COLORS.get(str(color_name).lower())
+    if hex_color is None:
         return "#000000"
+    return f"#{hex_color}"
 
 def color_name_to_hex_with_alpha(color_name, alpha=1.0, invert_alpha=False, bgr=False):
     """
     Convert a color name to a hex value with alpha (transparency).
     Alpha should be a float between 0.0 (fully transparent) and 1.0 (fully opaque).
     """
-    try:
-        # Get the hex color code without the '#' and convert to RGBA
-        hex_color = mcolors.to_hex(color_name)[1:]
-
-        # Scale alpha to 255 and convert to hex
-        alpha_hex = f"{int(alpha * 255):02X}"
-        if bgr:
-            hex_color = f"{hex_color[-2:]}{hex_color[2:4]}{hex_color[:2]}"
-        if invert_alpha:
-            return f"#{alpha_hex}{hex_color}"
-        return f"#{hex_color}{alpha_hex}"
-    except ValueError:
+    hex_color = NAMED_COLORS.get(str(color_name).lower())
+    if hex_color is None:
         return "#000000FF"  # Default to black with full opacity if color name not found
 
+    # Scale alpha to 255 and convert to hex
+    alpha_hex = f"{int(alpha * 255):02X}"
+    if bgr:
+        hex_color = f"{hex_color[-2:]}{hex_color[2:4]}{hex_color[:2]}"
+    if invert_alpha:
+        return f"#{alpha_hex}{hex_color}"
+    return f"#{hex_color}{alpha_hex}"
+
+def compile_style(style_name, style):
+    """Precompute the OGR style string and KML colors of a style rule."""
+    color = color_name_to_hex_with_alpha(style['color'], style.get("opacity", 0.5))
+    fillColor = color_name_to_hex_with_alpha(style.get('fillColor', 'none'), style.get('fillOpacity', 0.5))
+    ogr_style = f"PEN(c:{color},w:{style.get('weight', 1)}mm);BRUSH(fc:{fillColor})"
+
+    kml_color = color_name_to_hex_with_alpha(
+        style['color'],
+        style.get("opacity",0.5),
+        invert_alpha=True,
+        bgr=True
+    ).upper().replace("#","")
+    kml_style = (
+        f'<Style id="{style_name}">'
+        f'<LineStyle><color>{kml_color}</color><width>{style.get("weight", 1)}</width></LineStyle>'
+    )
+    if style.get('fillColor', 'none') != 'none':
+        kml_fill_color = color_name_to_hex_with_alpha(
+            style['fillColor'],
+            style.get("fillOpacity",0.5),
+            invert_alpha=True,
+            bgr=True
+        ).upper().replace("#","")
+        kml_style += f'<PolyStyle><color>{kml_fill_color}</color></PolyStyle>'
+    kml_style += '</Style>\n'
 
-def read_file_as_bytes(file_path):
-    with open(file_path, "rb") as file:
-        file_bytes = file.read()
-    return file_bytes
+    return {
+        "name": style_name,
+        "rule": style,
+        "ogr_style": ogr_style,
+        "kml_style": kml_style,
+    }
 
-def create_pdf_from_geojson(geojson_data, cod_imovel):
-    output_pdf = f'/tmp/{cod_imovel}.pdf'
-    # Create a temporary file to store the GeoJSON data
-    temp_geojson_file = '/tmp/temp_geojson.json'
-    with open(temp_geojson_file, 'w') as f:
-        json.dump(geojson_data, f)
+STYLE_TABLE = {
+    style_name: compile_style(style_name, style)
+    for style_name, style in {**STYLE_RULES, DEFAULT_STYLE_NAME: DEFAULT_STYLE}.items()
+}
 
-    # Open the GeoJSON file with OGR
-    driver = ogr.GetDriverByName('GeoJSON')
-    dataSource = driver.Open(temp_geojson_file, 0)  # 0 means read-only
 
-    if dataSource is None:
-        print('Could not open file')
-        return
+def create_pdf_from_features(features, cod_imovel):
+    tmpdir = vsimem_dir()
+    try:
+        return write_pdf_from_features(features, cod_imovel, tmpdir)
+    finally:
+        remove_vsimem_dir(tmpdir)
+
+def write_pdf_from_features(features, cod_imovel, tmpdir):
+    output_pdf = f'{tmpdir}/{cod_imovel}.pdf'
+
+    # Load the features into an in-memory OGR layer
+    dataSource = create_memory_dataset(features, cod_imovel)
+    in_lyr = dataSource.GetLayer(0)
 
     # Create a spatial reference
     spatialRef = osr.SpatialReference()
@@ -157,29 +289,22 @@ def create_pdf_from_geojson(geojson_data, cod_imovel):
 
     # Create a layer for the PDF
     output_layer = output_ds.CreateLayer('layer', srs=spatialRef, geom_type=ogr.wkbUnknown)
-    in_lyr = dataSource.GetLayerByIndex(0)
     lyr_def = in_lyr.GetLayerDefn ()
     for i in range(lyr_def.GetFieldCount()):
         output_layer.CreateField ( lyr_def.GetFieldDefn(i) )
     # Iterate through features and style them
-    for feature in dataSource.GetLayer():
+    for feature in in_lyr:
         geom = feature.GetGeometryRef()
         cod_tema = feature.GetField('cod_tema')
 
-        style = get_style_cod_theme(cod_tema)
-        fillOpacity = style.get('fillOpacity', 0.5)
-        # Apply the style to the feature
-        color = color_name_to_hex_with_alpha(style['color'], style.get("opacity", 0.5))
-        fillColor = color_name_to_hex_with_alpha(style.get('fillColor', 'none'), fillOpacity)
-        line_width = style.get("weight", 1)
+        # Apply the precompiled style to the feature
+        style = get_compiled_style(cod_tema)
         # Create a new feature with the same geometry
         new_feature = ogr.Feature(output_layer.GetLayerDefn())
         new_feature.SetGeometry(geom.Clone())
 
         # Set the style of the new feature
-        style_string = f"PEN(c:{color},w:{line_width}mm)"
-        if fillColor != 'none':
-            style_string += f";BRUSH(fc:{fillColor})"
+        style_string = style["ogr_style"]
         if cod_tema.lower() == "area_imovel":
             car_code = feature.GetField('cod_imovel')
             area_ha = feature.GetField('num_area')
@@ -212,62 +337,45 @@ def create_pdf_from_geojson(geojson_data, cod_imovel):
     # Close the data sources
     dataSource = None
     output_ds = None
-    file_data = read_file_as_bytes(output_pdf)
-    os.remove(output_pdf)
-    os.remove(temp_geojson_file)
-    return file_data
-
-def create_kmz_from_geojson(geojson_data, car_code):
-    output_kmz = f'/tmp/{car_code}.kmz'
-    # Create a KML object
-    kml = simplekml.Kml()
-
-    # Iterate through features and style them
-    for feature in geojson_data['features']:
-        cod_tema = feature['properties'].get('cod_tema')
-        style = get_style_cod_theme(cod_tema)
-
-        # Extract geometry and properties
-        geom = feature['geometry']
-        properties = feature['properties']
-
-        # Create a KML placemark for the feature
-        placemark = kml.newmultigeometry(name=cod_tema)
-        for coords in geom['coordinates']:
-            if geom['type'] == 'Polygon':
-                placemark.newpolygon(outerboundaryis=coords)
-            elif geom['type'] == 'MultiPolygon':
-                for polygon_coords in coords:
-                    placemark.newpolygon(outerboundaryis=polygon_coords)
-
-        # Apply style to the placemark
-        color = color_name_to_hex_with_alpha(
-            style['color'],
-            style.get("opacity",0.5),
-            invert_alpha=True,
-            bgr=True
-        ).upper()
-
-        fillColor = style.get('fillColor', 'none')
-        if fillColor != 'none':
-            fillColor = color_name_to_hex_with_alpha(
-                fillColor,
-                style.get("fillOpacity",0.5),
-                invert_alpha=True,
-                bgr=True
-            ).upper()
-
-        placemark.style.linestyle.color = color.replace("#","")
-        placemark.style.linestyle.width = style.get('weight', 1)
-        if fillColor != 'none':
-            placemark.style.polystyle.color = fillColor.replace("#","")
-
-        # Add attributes as description
-        description = "<br>".join(f"<b>{key}</b>: {value}" for key, value in properties.items())
-        placemark.description = description
-
-    # Save KML to a KMZ file
-    kml.savekmz(output_kmz)
-    file_data = read_file_as_bytes(output_kmz)
-    os.remove(output_kmz)
-    return file_data
\ No newline at end of file
+    return read_vsimem_file(output_pdf)
+
+KML_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<kml xmlns="http://www.opengis.net/kml/2.2"><Document>\n'
+)
+KML_FOOTER = '</Document></kml>\n'
+KML_STYLES = "".join(style["kml_style"] for style in STYLE_TABLE.values())
+
+def kml_placemark(style_id, cod_tema, geometry_wkb, properties):
+    # OGR writes every ring, so polygon holes are kept as innerBoundaryIs
+    geometry_kml = ogr.CreateGeometryFromWkb(geometry_wkb).ExportToKML()
+    description = "<br>".join(
+        f"<b>{html.escape(str(key))}</b>: {html.escape(str(value))}"
+        for key, value in properties.items()
+    )
+    return (
+        f'<Placemark><name>{html.escape(str(cod_tema))}</name>'
+        f'<description><![CDATA[{description}]]></description>'
+        f'<styleUrl>#{style_id}</styleUrl>{geometry_kml}</Placemark>\n'
+    )
+
+def create_kmz_from_features(features, car_code):
+    """Write the KMZ one placemark at a time into an in-memory zip.
+
+    Every compiled style is written in the document header, before the
+    first placemark, and placemarks reference it by id.
+    """
+    mem_zip = BytesIO()
+    with zipfile.ZipFile(mem_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        with zipf.open("doc.kml", "w") as kml_file:
+            kml_file.write(KML_HEADER.encode("utf-8"))
+            kml_file.write(f"<name>{html.escape(car_code)}</name>\n".encode("utf-8"))
+            kml_file.write(KML_STYLES.encode("utf-8"))
+
+            for geometry_wkb, properties in features:
+                cod_tema = properties.get('cod_tema')
+                style = get_compiled_style(cod_tema)
+                kml_file.write(kml_placemark(style["name"], cod_tema, geometry_wkb, properties).encode("utf-8"))
+
+            kml_file.write(KML_FOOTER.encode("utf-8"))
+    return mem_zip.getvalue()
@@ -1,20 +1,23 @@
 import os
 import json
-
-from collections import defaultdict
+import math
+import time
+import uuid
 
 from datetime import datetime, timedelta, timezone
 import jwt
-import asyncpg
-
-from asyncpg.pool import Pool
-from itertools import chain
+from contextlib import asynccontextmanager
 
 import asyncio
 import uvicorn
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from fastapi import (
     FastAPI,
+    Request,
     HTTPException,
     Depends,
     Security,
@@ -25,33 +28,187 @@ from fastapi.security.api_key import (
     APIKeyQuery,
     APIKey
 )
-from pydantic import BaseModel, constr
+from pydantic import BaseModel, constr, conlist
 
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
 
 import httpx
 
-from render_car import create_pdf_from_geojson, create_kmz_from_geojson, create_shapefile_from_geojson
+from render_car import create_pdf_from_features, create_kmz_from_features, create_shapefile_from_features, warm_up_renderer
+from layer_catalog import LayerCatalog
+from export_cache import ExportCache
+from tile_cache import TileCache, EMPTY_TILE
+from pmtiles_reader import PMTilesArchive
+from db_pool import MonitoredPool
+from token_cache import TokenCache
 
 query_timeout = int(os.getenv("QUERY_TIMEOUT", "30"))
+stream_batch_size = int(os.getenv("STREAM_BATCH_SIZE", "200"))
+MAX_BATCH_POINTS = int(os.getenv("MAX_BATCH_POINTS", "1000"))
+render_workers = int(os.getenv("RENDER_WORKERS", "2"))
+render_timeout = int(os.getenv("RENDER_TIMEOUT", "60"))
 
 DATABASE_HOST = os.getenv("POSTGRES_HOST", "localhost")
 DATABASE_PORT = os.getenv("POSTGRES_PORT", "5432")
 DATABASE_NAME = os.getenv("POSTGRES_DB", "car")
 DATABASE_USER = os.getenv("POSTGRES_USER", "postgres")
 DATABASE_PASSWORD = os.getenv("POSTGRES_PASSWORD", "postgres")
+# Connections the API may hold across all gunicorn workers, split evenly
+# (plus one catalog listener connection per worker)
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "20"))
+# Always set under gunicorn by gunicorn_conf.on_starting, unset means a
+# single uvicorn process
+GUNICORN_WORKERS = int(os.getenv("GUNICORN_WORKERS", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", str(max(1, DB_MAX_CONNECTIONS // GUNICORN_WORKERS))))
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", str(min(2, DB_POOL_MAX_SIZE))))
 
 PMTILES_SERVER_URL = os.getenv("PMTILES_SERVER_URL", "http://localhost:8081")
+BASEMAP_VERSION = os.getenv("BASEMAP_VERSION", "1")
+# When set, tiles are read from this local archive instead of PMTILES_SERVER_URL
+PMTILES_PATH = os.getenv("PMTILES_PATH")
+# How often to check whether the ETL replaced the archive
+PMTILES_RELOAD_SECONDS = int(os.getenv("PMTILES_RELOAD_SECONDS", "30"))
+TILE_MAX_AGE = int(os.getenv("TILE_MAX_AGE", "86400"))
+# Deepest zoom a PMTiles tile id can address
+MAX_TILE_ZOOM = 31
+MVT_MIN_ZOOM = int(os.getenv("MVT_MIN_ZOOM", "10"))
+MVT_MAX_ZOOM = int(os.getenv("MVT_MAX_ZOOM", "18"))
+# Zoom from which theme tiles carry more than car_code
+MVT_DETAIL_ZOOM = int(os.getenv("MVT_DETAIL_ZOOM", "13"))
+# Simplification tolerance, in screen pixels of a 256px tile
+MVT_SIMPLIFY_PIXELS = float(os.getenv("MVT_SIMPLIFY_PIXELS", "1.0"))
+# /features page size and simplification tolerance, in pixels of a 256px tile
+FEATURES_PAGE_SIZE = int(os.getenv("FEATURES_PAGE_SIZE", "500"))
+FEATURES_MAX_PAGE_SIZE = int(os.getenv("FEATURES_MAX_PAGE_SIZE", "2000"))
+FEATURES_SIMPLIFY_PIXELS = float(os.getenv("FEATURES_SIMPLIFY_PIXELS", "0.5"))
 API_KEYS = os.getenv("API_KEYS", "1234,5678").split(",")
 
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "ABCD")
-JWT_VALID_SECONDS = os.getenv("JWT_VALID_SECONDS", "3600")
+JWT_VALID_SECONDS = int(os.getenv("JWT_VALID_SECONDS", "3600"))
 
 API_KEY_QUERY_NAME = os.getenv("API_KEY_QUERY_NAME", "API_KEY")
 api_key_query = APIKeyQuery(name=API_KEY_QUERY_NAME, auto_error=False)
 
-app = FastAPI(root_path="/api")
+DB_CONNECT_KWARGS = dict(
+    user=DATABASE_USER,
+    password=DATABASE_PASSWORD,
+    database=DATABASE_NAME,
+    host=DATABASE_HOST,
+    port=DATABASE_PORT,
+)
+
+layer_catalog = LayerCatalog(DB_CONNECT_KWARGS)
+db_pool = MonitoredPool(DB_CONNECT_KWARGS, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, acquire_timeout=query_timeout)
+export_cache = ExportCache()
+tile_cache = TileCache()
+token_cache = TokenCache()
+pmtiles_archive: PMTilesArchive = None
+pmtiles_checked_at = 0.0
+
+def current_pmtiles_archive():
+    """The open basemap archive, reopened once the ETL has swapped the file.
+
+    The ETL renames a new archive over PMTILES_PATH, so the path points to a
+    different inode from then on, while requests already holding tiles of
+    the previous archive keep its mapping alive until they finish.
+    """
+    global pmtiles_archive, pmtiles_checked_at
+    if not PMTILES_PATH:
+        return None
+    now = time.monotonic()
+    if pmtiles_archive is not None and now - pmtiles_checked_at < PMTILES_RELOAD_SECONDS:
+        return pmtiles_archive
+    pmtiles_checked_at = now
+    try:
+        stat = os.stat(PMTILES_PATH)
+    except FileNotFoundError:
+        return pmtiles_archive
+    if pmtiles_archive is None or pmtiles_archive.version != f"{stat.st_ino:x}-{stat.st_mtime_ns:x}":
+        previous_archive = pmtiles_archive
+        pmtiles_archive = PMTilesArchive(PMTILES_PATH)
+        print(f"Opened basemap archive {PMTILES_PATH} version {pmtiles_archive.version}")
+        if previous_archive is not None:
+            previous_archive.close()
+    return pmtiles_archive
+
+render_executor: ProcessPoolExecutor = None
+
+def start_render_executor():
+    """Start the export render pool with every process already spawned.
+
+    The pool only spawns a process when a job is submitted, so one warm-up
+    job per worker is submitted right away, not awaited, and each process
+    imports GDAL before the first export reaches it.
+    """
+    global render_executor
+    render_executor = ProcessPoolExecutor(
+        max_workers=render_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=warm_up_renderer
+    )
+    for _ in range(render_workers):
+        render_executor.submit(warm_up_renderer)
+
+def recycle_render_executor(executor):
+    """Replace `executor` with a new pool and kill its render processes.
+
+    Killing the processes is the only way to stop a job that is still
+    running, renders of other requests on the old pool answer 503.
+    """
+    if executor is not render_executor:
+        # Already replaced by a concurrent request
+        return
+    processes = list((executor._processes or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+    start_render_executor()
+
+async def render_export(renderer, *args):
+    """Run a GDAL/KML renderer off the event loop.
+
+    A job running past RENDER_TIMEOUT is answered with 504 and its pool is
+    recycled, so the stuck process does not keep a worker slot.
+    """
+    loop = asyncio.get_running_loop()
+    executor = render_executor
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(executor, renderer, *args),
+            timeout=render_timeout
+        )
+    except asyncio.TimeoutError:
+        recycle_render_executor(executor)
+        raise HTTPException(status_code=504, detail="Render timeout")
+    except BrokenProcessPool:
+        if executor is not render_executor:
+            # Killed by another request recycling the pool
+            raise HTTPException(status_code=503, detail="Render pool restarted, retry")
+        # A render process died (e.g. GDAL crash), replace the pool for next requests
+        recycle_render_executor(executor)
+        raise HTTPException(status_code=500, detail="Render worker crashed")
+    except asyncio.CancelledError:
+        # Jobs still queued when another request recycled the pool are
+        # cancelled with it; a cancelled request (client gone) propagates
+        if executor is render_executor or asyncio.current_task().cancelling():
+            raise
+        raise HTTPException(status_code=503, detail="Render pool restarted, retry")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await layer_catalog.start()
+    await db_pool.open(hot_queries=HOT_QUERIES)
+    start_render_executor()
+    current_pmtiles_archive()
+    yield
+    if pmtiles_archive is not None:
+        pmtiles_archive.close()
+    render_executor.shutdown(wait=False, cancel_futures=True)
+    await db_pool.close()
+    await layer_catalog.close()
+
+app = FastAPI(root_path="/api", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -62,39 +219,8 @@ app.add_middleware(
 )
 
 
-db_pool: Pool = None
-
 httpx_client = httpx.AsyncClient()
 
-async def init_db_pool():
-    global db_pool
-    if db_pool is None:
-        db_pool = await asyncpg.create_pool(
-            user=DATABASE_USER,
-            password=DATABASE_PASSWORD,
-            database=DATABASE_NAME,
-            host=DATABASE_HOST,
-            port=DATABASE_PORT,
-            min_size=1,
-            max_size=10  # Tune this based on Raspberry Pi memory
-        )
-
-async def get_db_conn():
-    global db_pool
-    if db_pool is None:
-        await init_db_pool()
-    return await db_pool.acquire()
-
-from contextlib import asynccontextmanager
-
-@asynccontextmanager
-async def get_temp_conn():
-    conn = await get_db_conn()
-    try:
-        yield conn
-    finally:
-        await db_pool.release(conn)
-
 class StateModel(BaseModel):
     state: constr(strip_whitespace=True, min_length=2, max_length=2)
 
@@ -109,6 +235,9 @@ class PointModel(BaseModel):
     latitude: float
     longitude: float
 
+class PointsModel(BaseModel):
+    points: conlist(PointModel, min_length=1, max_length=MAX_BATCH_POINTS)
+
 def get_api_key(
     api_key_query: str = Security(api_key_query),
 ):
@@ -125,16 +254,29 @@ def create_token(data: dict, expires_delta: timedelta):
     return encoded_jwt
 
 def verify_token_from_query(token: str):
+    # A map session sends the same token with every tile, only the first
+    # request pays for the signature check
+    key = token_cache.make_key(token)
+    expires_at = token_cache.get(key)
+    if expires_at is not None:
+        if time.time() < expires_at:
+            return True
+        token_cache.discard(key)
+        raise HTTPException(status_code=401, detail="Token has expired")
+
     try:
         payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"])
         if payload["sub"] != "tiles_access":
             raise HTTPException(status_code=403, detail="Invalid token")
-        return True
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+    if "exp" in payload:
+        token_cache.put(key, payload["exp"])
+    return True
+
 with open("map.html", "r") as file:
     html_template = file.read()
 
@@ -150,39 +292,186 @@ async def get_token(api_key: APIKey = Depends(get_api_key)):
 
     return {"token": token}
 
+@app.get("/cache-stats")
+async def cache_stats(api_key: APIKey = Depends(get_api_key)):
+    return {
+        "export_cache": export_cache.stats(),
+        "tile_cache": tile_cache.stats(),
+        "token_cache": token_cache.stats(),
+    }
+
+@app.get("/pool-stats")
+async def pool_stats(api_key: APIKey = Depends(get_api_key)):
+    return db_pool.stats()
+
 @app.get("/list-layers")
 async def list_layers(token: str = Query(..., description="Map token required for access")):
     if not token:
         raise HTTPException(status_code=400, detail="TOKEN is required")
     verify_token_from_query(token)
 
+    # Served from the worker's catalog copy, refreshed on ETL NOTIFY
+    return Response(
+        content=layer_catalog.body,
+        media_type="application/json",
+        headers={"ETag": f'"{layer_catalog.version}"'}
+    )
+
+def car_features_query(table_names):
+    """UNION ALL of one car_code lookup per theme partition.
+
+    Table names are sorted so the same set of partitions always yields the
+    same text and hits asyncpg's per-connection prepared statement cache.
+    """
+    return "\nUNION ALL\n".join(
+        f"""
+            SELECT geom, properties
+            FROM {table_name}
+            WHERE car_code = $1
+        """
+        for table_name in sorted(table_names)
+    )
+
+def feature_rows_query(features_query):
+    """One row per feature, geometry as WKB, for the export renderers."""
+    return f"""
+        SELECT
+            ST_AsBinary(geom) as geom_wkb,
+            properties
+        FROM ({features_query}) AS features
+    """
+
+def feature_collection_query(features_query):
+    """Whole FeatureCollection assembled by Postgres as UTF-8 bytes.
+
+    bytea comes back from asyncpg as bytes, which are sent untouched
+    instead of being decoded and re-encoded in Python.
+    """
+    return f"""
+        SELECT
+            count(*) AS feature_count,
+            convert_to(
+                json_build_object(
+                    'type', 'FeatureCollection',
+                    'features', COALESCE(
+                        json_agg(
+                            json_build_object(
+                                'type', 'Feature',
+                                'geometry', ST_AsGeoJSON(geom)::json,
+                                'properties', properties
+                            )
+                        ),
+                        '[]'::json
+                    )
+                )::text,
+                'UTF8'
+            ) AS feature_collection
+        FROM ({features_query}) AS features
+    """
+
+def feature_json_query(features_query):
+    """One UTF-8 encoded GeoJSON Feature per row, for streamed responses."""
+    return f"""
+        SELECT
+            convert_to(
+                json_build_object(
+                    'type', 'Feature',
+                    'geometry', ST_AsGeoJSON(geom)::json,
+                    'properties', properties
+                )::text,
+                'UTF8'
+            ) AS feature
+        FROM ({features_query}) AS features
+    """
+
+EMPTY_FEATURE_COLLECTION = b'{"type":"FeatureCollection","features":[]}'
+
+async def stream_features(query, *args, ndjson=False):
+    """Stream features from a server-side cursor in batches.
+
+    Returns None when the query has no rows, so callers can still answer
+    with a 404 or an empty collection before any byte is sent. Otherwise the
+    connection stays checked out until the response body is fully written.
+    """
     try:
-        async with get_temp_conn() as conn:
-            query = """
-            SELECT distinct on (state_code, layer)
-            state_code, layer, release_date, count_active_features, created_at
-            FROM car_statistics
-            ORDER BY state_code, layer, release_date DESC
-            """
-            results = await conn.fetch(query)
-            await conn.close()
-            layers = defaultdict(dict)
-            for record in results:
-                layers[record["state_code"]][record["layer"]] = {
-                    "release_date": record["release_date"].isoformat(),
-                    "feature_count": record["count_active_features"],
-                    "download_date": record["created_at"]
-                }
-            return layers
+        conn = await db_pool.acquire("stream_features")
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Database query timeout")
+    transaction = conn.transaction()
+    started = False
+
+    async def release():
+        try:
+            # A transaction that failed to start has nothing to roll back,
+            # and rollback() would raise over the original error
+            if started:
+                await transaction.rollback()
+        finally:
+            await db_pool.release(conn)
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    try:
+        await transaction.start()
+        started = True
+        statement = await conn.prepared(feature_json_query(query))
+        cursor = await statement.cursor(*args)
+        batch = await cursor.fetch(stream_batch_size, timeout=query_timeout)
+    except asyncio.TimeoutError:
+        await release()
+        raise HTTPException(status_code=504, detail="Database query timeout")
+    except BaseException:
+        await release()
+        raise
+
+    if not batch:
+        await release()
+        return None
+
+    async def body(batch):
+        try:
+            if not ndjson:
+                yield b'{"type":"FeatureCollection","features":['
+            separator = b"\n" if ndjson else b","
+            first = True
+            while batch:
+                chunk = separator.join(row["feature"] for row in batch)
+                if ndjson:
+                    yield chunk + b"\n"
+                else:
+                    yield chunk if first else b"," + chunk
+                first = False
+                if len(batch) < stream_batch_size:
+                    break
+                batch = await cursor.fetch(stream_batch_size, timeout=query_timeout)
+            if not ndjson:
+                yield b"]}"
+        finally:
+            await release()
+
+    media_type = "application/x-ndjson" if ndjson else "application/json"
+    return StreamingResponse(body(batch), media_type=media_type)
+
+async def fetch_prepared(query, *args, fetchrow=False):
+    try:
+        async with db_pool.connection("fetch_prepared") as conn:
+            statement = await conn.prepared(query)
+            if fetchrow:
+                return await statement.fetchrow(*args, timeout=query_timeout)
+            return await statement.fetch(*args, timeout=query_timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Database query timeout")
+
+EXPORT_FORMATS = {
+    "pdf": (create_pdf_from_features, "application/pdf", "pdf"),
+    "kmz": (create_kmz_from_features, "application/vnd.google-earth.kmz", "kmz"),
+    "shp": (create_shapefile_from_features, "application/zip", "zip"),
+}
 
 @app.get("/layers/{car_code}.{file_format}")
 async def get_layers(
     car_code: str,
-    file_format: str = Path(..., description="Format of the response: 'geojson', 'kmz' 'shp' or 'pdf'", pattern="^(geojson|pdf|kmz|shp)$"),
+    file_format: str = Path(..., description="Format of the response: 'geojson', 'ndjson', 'kmz' 'shp' or 'pdf'", pattern="^(geojson|ndjson|pdf|kmz|shp)$"),
     layer: str = Query(None, description="Optional layer to fetch data from"),
+    stream: bool = Query(False, description="Stream geojson features in batches from a server-side cursor"),
     token: str = Query(..., description="token required for access")
 ):
 
@@ -195,143 +484,362 @@ async def get_layers(
     params = CodImovelModel(car_code=car_code)
     state_code = params.car_code[:2]
 
-    conn = await get_db_conn()
-
-    layer_filter = ""
+    layer_value = None
     if layer:
         layer_value = ''.join([char.upper() for char in layer[:256] if char.isalpha() or char=='_'])
-        layer_filter = f" AND layer = '{layer_value}' "
-
-
-    async with get_temp_conn() as conn:
-        theme_tables = await conn.fetch(
-            f"""
-            SELECT DISTINCT ON (state_code, layer)
-                layer
-            FROM car_statistics
-            WHERE state_code = $1
-            {layer_filter}
-            ORDER BY state_code, layer, release_date DESC
-            """,
-            state_code
-        )
 
-
-    if not theme_tables:
+    table_names = layer_catalog.table_names(state_code, layer_value)
+    if not table_names:
         raise HTTPException(status_code=404, detail="Layer not found")
 
-    table_names = [f"{table['layer']}_{state_code.lower()}" for table in theme_tables]
+    # One prepared statement over every theme partition, so a request
+    # holds a single pool connection regardless of the theme count
+    features_query = car_features_query(table_names)
+
+    if file_format == "ndjson" or (file_format == "geojson" and stream):
+        response = await stream_features(features_query, params.car_code, ndjson=file_format == "ndjson")
+        if response is None:
+            raise HTTPException(status_code=404, detail="CAR not found")
+        return response
+
+    if file_format == "geojson":
+        result = await fetch_prepared(
+            feature_collection_query(features_query),
+            params.car_code,
+            fetchrow=True
+        )
+        if result["feature_count"] == 0:
+            raise HTTPException(status_code=404, detail="CAR not found")
+        return Response(content=result["feature_collection"], media_type="application/json")
+
+    renderer, media_type, extension = EXPORT_FORMATS[file_format]
+    cache_key = export_cache.make_key(
+        params.car_code,
+        file_format,
+        layer_value,
+        layer_catalog.release_key(state_code, layer_value)
+    )
+    file_bytes = await export_cache.get(cache_key)
+
+    if file_bytes is None:
+        feature_results = await fetch_prepared(feature_rows_query(features_query), params.car_code)
+
+        features = [
+            (row["geom_wkb"], json.loads(row["properties"]))
+            for row in feature_results
+        ]
 
-    async def fetch_table_features(table_name: str):
-        async with get_temp_conn() as conn:
-            query = f"""
-                SELECT
-                    ST_AsGeoJSON(geom)::jsonb as geom_json,
-                    properties
-                FROM {table_name}
-                WHERE car_code = $1
-            """
-            return await conn.fetch(query, params.car_code)
+        if len(features) == 0:
+            raise HTTPException(status_code=404, detail="CAR not found")
+
+        file_bytes = await render_export(renderer, features, car_code)
+        if file_bytes is None:
+            raise HTTPException(status_code=500, detail=f"Could not render {file_format}")
+        await export_cache.put(cache_key, file_bytes)
+
+    return Response(
+        content=file_bytes,
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={car_code}.{extension}"}
+    )
+
+POINT_FEATURES_QUERY = """
+    SELECT geom, properties
+    FROM area_imovel
+    WHERE ST_Intersects(geom, ST_SetSRID(ST_MakePoint($1, $2), 4326))
+"""
+
+# Filtering on the partition key lets Postgres skip the GiST probe of every
+# state the routing index ruled out
+ROUTED_POINT_FEATURES_QUERY = POINT_FEATURES_QUERY + """
+    AND state_code = ANY($3::text[])
+"""
+
+def batch_point_features_query(routed):
+    state_filter = "AND area_imovel.state_code = ANY($3::text[])" if routed else ""
+    return f"""
+    WITH points AS (
+        SELECT
+            idx,
+            longitude,
+            latitude,
+            ST_SetSRID(ST_MakePoint(longitude, latitude), 4326) AS geom
+        FROM unnest($1::float8[], $2::float8[]) WITH ORDINALITY AS p(longitude, latitude, idx)
+    ),
+    point_features AS (
+        SELECT
+            points.idx,
+            points.longitude,
+            points.latitude,
+            COALESCE(
+                json_agg(
+                    json_build_object(
+                        'type', 'Feature',
+                        'geometry', ST_AsGeoJSON(area_imovel.geom)::json,
+                        'properties', area_imovel.properties
+                    )
+                ) FILTER (WHERE area_imovel.geom IS NOT NULL),
+                '[]'::json
+            ) AS features
+        FROM points
+        LEFT JOIN area_imovel ON ST_Intersects(area_imovel.geom, points.geom)
+            {state_filter}
+        GROUP BY points.idx, points.longitude, points.latitude
+    )
+    SELECT
+        convert_to(
+            json_build_object(
+                'results', json_agg(
+                    json_build_object(
+                        'type', 'FeatureCollection',
+                        'point', json_build_object('longitude', longitude, 'latitude', latitude),
+                        'features', features
+                    )
+                    ORDER BY idx
+                )
+            )::text,
+            'UTF8'
+        ) AS results
+    FROM point_features
+"""
+
+# Prepared on every pool connection as it opens
+HOT_QUERIES = [
+    feature_collection_query(POINT_FEATURES_QUERY),
+    feature_collection_query(ROUTED_POINT_FEATURES_QUERY),
+    batch_point_features_query(routed=False),
+    batch_point_features_query(routed=True),
+]
+
+def point_states(longitude, latitude):
+    """States whose area_imovel partition may hold the point, None if unknown."""
+    return layer_catalog.candidate_states("area_imovel", longitude, latitude)
 
-    try:
-        feature_results = await asyncio.wait_for(
-            asyncio.gather(*[fetch_table_features(tbl) for tbl in table_names]),
-            timeout=query_timeout
-        )
-    except asyncio.TimeoutError:
-        raise HTTPException(status_code=504, detail="Database query timeout")
+@app.post("/intersecting-perimeters")
+async def intersecting_perimeters(
+    point: PointModel,
+    token: str = Query(..., description="token required for access"),
+    stream: bool = Query(False, description="Stream features in batches from a server-side cursor"),
+    output: str = Query("geojson", description="Output as a 'geojson' FeatureCollection or streamed 'ndjson'", pattern="^(geojson|ndjson)$")
+):
 
-    geojson_features = {
-        "type": "FeatureCollection",
-        "features": [
-            {
-                "type": "Feature",
-                "geometry": json.loads(row["geom_json"]),
-                "properties": json.loads(row["properties"]),
-            }
-            for row in chain.from_iterable(feature_results)
-        ]
-    }
+    if not token:
+        raise HTTPException(status_code=400, detail="TOKEN is required")
 
-    if len(geojson_features["features"]) == 0:
-        raise HTTPException(status_code=404, detail="CAR not found")
+    verify_token_from_query(token)
 
-    if file_format == "pdf":
-        pdf_file_bytes = create_pdf_from_geojson(geojson_features, car_code)
-        return Response(
-            content=pdf_file_bytes,
-            media_type="application/pdf",
-            headers={"Content-Disposition": f"attachment; filename={car_code}.pdf"}
-        )
+    ndjson = output == "ndjson"
+    empty_response = Response(
+        content=b"" if ndjson else EMPTY_FEATURE_COLLECTION,
+        media_type="application/x-ndjson" if ndjson else "application/json"
+    )
+
+    states = point_states(point.longitude, point.latitude)
+    if states is None:
+        features_query = POINT_FEATURES_QUERY
+        point_args = (point.longitude, point.latitude)
+    elif not states:
+        # Outside every partition extent, nothing to look up
+        return empty_response
+    else:
+        features_query = ROUTED_POINT_FEATURES_QUERY
+        point_args = (point.longitude, point.latitude, states)
 
-    elif file_format == "kmz":
-        pdf_file_bytes = create_kmz_from_geojson(geojson_features, car_code)
-        return Response(
-            content=pdf_file_bytes,
-            media_type="application/vnd.google-earth.kmz",
-            headers={"Content-Disposition": f"attachment; filename={car_code}.kmz"}
-        )
-    elif file_format == "geojson":
-        return geojson_features
-
-    elif file_format == "shp":
-        shp_zip_bytes = create_shapefile_from_geojson(geojson_features, car_code)
-        return Response(
-            content=shp_zip_bytes,
-            media_type="application/zip",
-            headers={"Content-Disposition": f"attachment; filename={car_code}.zip"}
-        )
+    if stream or ndjson:
+        response = await stream_features(features_query, *point_args, ndjson=ndjson)
+        return response if response is not None else empty_response
 
-    raise HTTPException(status_code=400, detail="Unsupported format requested")
+    try:
+        result = await fetch_prepared(feature_collection_query(features_query), *point_args, fetchrow=True)
+        return Response(content=result["feature_collection"], media_type="application/json")
 
-@app.post("/intersecting-perimeters")
-async def intersecting_perimeters(
-    point: PointModel,
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/intersecting-perimeters/batch")
+async def intersecting_perimeters_batch(
+    points: PointsModel,
     token: str = Query(..., description="token required for access")
 ):
+    """Answer many points in one query, one FeatureCollection per point in input order."""
 
     if not token:
         raise HTTPException(status_code=400, detail="TOKEN is required")
 
     verify_token_from_query(token)
 
-    point_geometry = f"ST_SetSrid(ST_MakePoint({point.longitude}, {point.latitude}), 4326)"
+    longitudes = [point.longitude for point in points.points]
+    latitudes = [point.latitude for point in points.points]
 
-    intersecting_perimeters = []
+    query_args = (longitudes, latitudes)
+    states = set()
+    for point in points.points:
+        point_candidates = point_states(point.longitude, point.latitude)
+        if point_candidates is None:
+            states = None
+            break
+        states.update(point_candidates)
+    if states is not None:
+        query_args += (sorted(states), )
 
-    table_name = "area_imovel"
     try:
-        async with get_temp_conn() as conn:
-
-            features = await asyncio.wait_for(
-                conn.fetch(
-                    f'SELECT ST_AsGeoJSON(geom)::jsonb as geom_json, properties FROM {table_name} WHERE ST_Intersects(geom, {point_geometry})',
-                    timeout=query_timeout
-                ),
-                timeout=query_timeout
-            )
-
-        for feature in features:
-            geojson_feature = {
-                "type": "Feature",
-                "geometry": json.loads(feature["geom_json"]),
-                "properties": json.loads(feature["properties"])
-            }
-            intersecting_perimeters.append(geojson_feature)
-
-        geojson_response = {
-            "type": "FeatureCollection",
-            "features": intersecting_perimeters
-        }
-
-        return geojson_response
+        result = await fetch_prepared(
+            batch_point_features_query(routed=states is not None),
+            *query_args,
+            fetchrow=True
+        )
+        return Response(content=result["results"], media_type="application/json")
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def bbox_features_query(table_names, routed, after):
+    """One page of features intersecting $1..$4, ordered by id.
+
+    Every table is read in id order from the `after` cursor (the primary
+    key), so a deep page costs the same as the first one, unlike OFFSET.
+    Parameters: bbox $1..$4, page size $5, simplify tolerance $6, decimal
+    digits $7, then the id cursor and the routed states when used.
+    """
+    next_param = 8
+    filters = ["geom && ST_MakeEnvelope($1, $2, $3, $4, 4326)"]
+    if after:
+        filters.append(f"id > ${next_param}::uuid")
+        next_param += 1
+    if routed:
+        filters.append(f"state_code = ANY(${next_param}::text[])")
+    where = " AND ".join(filters)
+
+    page_query = "\nUNION ALL\n".join(
+        f"""
+            (SELECT id, geom, properties
+            FROM {table_name}
+            WHERE {where}
+            ORDER BY id
+            LIMIT $5)
+        """
+        for table_name in sorted(table_names)
+    )
+    return f"""
+        WITH page AS (
+            SELECT id, geom, properties
+            FROM ({page_query}) AS features
+            ORDER BY id
+            LIMIT $5
+        )
+        SELECT
+            convert_to(
+                json_build_object(
+                    'type', 'FeatureCollection',
+                    'features', COALESCE(
+                        json_agg(
+                            json_build_object(
+                                'type', 'Feature',
+                                'id', id,
+                                'geometry', ST_AsGeoJSON(ST_SimplifyPreserveTopology(geom, $6), $7)::json,
+                                'properties', properties
+                            )
+                            ORDER BY id
+                        ),
+                        '[]'::json
+                    ),
+                    'next', CASE WHEN count(*) = $5 THEN (array_agg(id ORDER BY id DESC))[1] END
+                )::text,
+                'UTF8'
+            ) AS feature_collection
+        FROM page
+    """
+
+def parse_bbox(bbox):
+    try:
+        xmin, ymin, xmax, ymax = [float(value) for value in bbox.split(",")]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be xmin,ymin,xmax,ymax")
+    if not (-180 <= xmin < xmax <= 180 and -90 <= ymin < ymax <= 90):
+        raise HTTPException(status_code=400, detail="bbox out of range")
+    return xmin, ymin, xmax, ymax
+
+@app.get("/features")
+async def get_features(
+    bbox: str = Query(..., description="Viewport as xmin,ymin,xmax,ymax in EPSG:4326"),
+    zoom: int = Query(..., ge=0, le=22, description="Map zoom, sets simplification and coordinate precision"),
+    layer: list[str] = Query(["AREA_IMOVEL"], description="Layers to fetch, repeat for several"),
+    limit: int = Query(FEATURES_PAGE_SIZE, ge=1, le=FEATURES_MAX_PAGE_SIZE, description="Features per page"),
+    after: str = Query(None, description="The 'next' value of the previous page"),
+    token: str = Query(..., description="token required for access")
+):
+    """Features intersecting a viewport, simplified for the zoom and paged by id."""
+
+    if not token:
+        raise HTTPException(status_code=400, detail="TOKEN is required")
+
+    verify_token_from_query(token)
+
+    xmin, ymin, xmax, ymax = parse_bbox(bbox)
+    table_names = set()
+    for layer_name in layer:
+        table_name = ''.join([char.lower() for char in layer_name[:256] if char.isalpha() or char == '_'])
+        if table_name not in layer_catalog.layer_versions:
+            raise HTTPException(status_code=404, detail="Layer not found")
+        table_names.add(table_name)
+
+    query_args = []
+    if after is not None:
+        try:
+            query_args.append(str(uuid.UUID(after)))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid 'after' cursor")
+
+    # Only the states whose extents meet the viewport, for every layer asked
+    states = set()
+    for table_name in table_names:
+        table_states = layer_catalog.candidate_states(table_name, xmin, ymin, xmax, ymax)
+        if table_states is None:
+            states = None
+            break
+        states.update(table_states)
+    if states is not None:
+        query_args.append(sorted(states))
+
+    # Degrees per pixel of a 256px tile, and the decimals that still
+    # tell apart two pixels at this zoom
+    pixel_degrees = 360 / (256 * 2 ** zoom)
+    tolerance = FEATURES_SIMPLIFY_PIXELS * pixel_degrees
+    decimals = min(9, max(0, math.ceil(-math.log10(pixel_degrees)) + 1))
+
+    result = await fetch_prepared(
+        bbox_features_query(table_names, routed=states is not None, after=after is not None),
+        xmin, ymin, xmax, ymax, limit, tolerance, decimals, *query_args,
+        fetchrow=True
+    )
+    return Response(content=result["feature_collection"], media_type="application/json")
+
+
+class BufferResponse(Response):
+    """Response sending any bytes-like body, e.g. a memoryview, without copying it."""
+
+    def render(self, content):
+        return content
+
+def tile_headers(etag):
+    return {"ETag": etag, "Cache-Control": f"private, max-age={TILE_MAX_AGE}"}
+
+def etag_matches(request: Request, etag):
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+
+def tile_in_range(z, x, y, max_zoom=MAX_TILE_ZOOM):
+    # z is checked first, 1 << z raises on a negative zoom
+    return 0 <= z <= max_zoom and 0 <= x < 1 << z and 0 <= y < 1 << z
 
 @app.get("/tiles/{z}/{x}/{y}.pbf")
-async def get_tile(z: int, x: int, y: int, token: str = Query(..., description="token required for access")):
+async def get_tile(request: Request, z: int, x: int, y: int, token: str = Query(..., description="token required for access")):
     """Get area_imovel layer as Vector Tiles."""
 
     if not token:
@@ -340,14 +848,128 @@ async def get_tile(z: int, x: int, y: int, token: str = Query(..., description="
     # Verify the token from the query param
     verify_token_from_query(token)
 
-    pmtiles_url = f"{PMTILES_SERVER_URL}/area_imovel/{z}/{x}/{y}.mvt"
+    if not tile_in_range(z, x, y):
+        raise HTTPException(status_code=404, detail="Tile out of range")
+
+    # Tile content only changes with the basemap, so its version is enough
+    # to validate what the browser already has without touching the tile
+    archive = current_pmtiles_archive()
+    basemap_version = archive.version if archive is not None else BASEMAP_VERSION
+    etag = f'"{basemap_version}-{z}-{x}-{y}"'
+    headers = tile_headers(etag)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    if archive is not None:
+        # Local archive: the mmap is already page cached, serve the range as is
+        tile = archive.get_tile(z, x, y)
+        if not tile:
+            return Response(status_code=204, headers=headers)
+        if archive.content_encoding:
+            headers["Content-Encoding"] = archive.content_encoding
+        return BufferResponse(content=tile, media_type='application/x-protobuf', headers=headers)
+
+    tile_key = f"basemap/{z}/{x}/{y}"
+    tile = await tile_cache.get(BASEMAP_VERSION, tile_key)
+
+    if tile is None:
+        pmtiles_url = f"{PMTILES_SERVER_URL}/area_imovel/{z}/{x}/{y}.mvt"
+
+        try:
+            response = await httpx_client.get(pmtiles_url)
+        except httpx.RequestError as e:
+            raise HTTPException(status_code=404, detail=f"Tile not found: {e}")
+
+        if response.status_code in (204, 404):
+            tile = EMPTY_TILE
+        elif response.is_success:
+            tile = response.content
+        else:
+            raise HTTPException(status_code=502, detail=f"Tile server answered {response.status_code}")
+        await tile_cache.put(BASEMAP_VERSION, tile_key, tile)
+
+    if tile == EMPTY_TILE:
+        return Response(status_code=204, headers=headers)
+    return Response(content=tile, media_type='application/x-protobuf', headers=headers)
+
+def theme_tile_query(table_name, detailed):
+    attributes = "t.car_code"
+    if detailed:
+        attributes += """,
+                t.properties->>'cod_tema' AS cod_tema,
+                t.properties->>'num_area' AS num_area"""
+    return f"""
+        WITH bounds AS (
+            SELECT
+                ST_TileEnvelope($1, $2, $3) AS geom_3857,
+                ST_Transform(ST_TileEnvelope($1, $2, $3), 4326) AS geom_4326
+        ),
+        features AS (
+            SELECT
+                ST_AsMVTGeom(
+                    ST_Transform(ST_SimplifyPreserveTopology(t.geom, $4), 3857),
+                    bounds.geom_3857,
+                    4096,
+                    64,
+                    true
+                ) AS geom,
+                {attributes}
+            FROM {table_name} t, bounds
+            WHERE t.geom && bounds.geom_4326
+        )
+        SELECT ST_AsMVT(features, $5, 4096, 'geom') AS tile
+        FROM features
+        WHERE geom IS NOT NULL
+    """
+
+@app.get("/tiles/{layer}/{z}/{x}/{y}.pbf")
+async def get_theme_tile(
+    request: Request,
+    layer: str,
+    z: int,
+    x: int,
+    y: int,
+    token: str = Query(..., description="token required for access")
+):
+    """Get any CAR theme layer as Vector Tiles generated by PostGIS."""
+
+    if not token:
+        raise HTTPException(status_code=400, detail="TOKEN is required")
+
+    verify_token_from_query(token)
+
+    table_name = ''.join([char.lower() for char in layer[:256] if char.isalpha() or char == '_'])
+    layer_version = layer_catalog.layer_versions.get(table_name)
+    if layer_version is None:
+        raise HTTPException(status_code=404, detail="Layer not found")
+    if not tile_in_range(z, x, y, MVT_MAX_ZOOM):
+        raise HTTPException(status_code=404, detail="Tile out of range")
+
+    etag = f'"{layer_version}-{z}-{x}-{y}"'
+    headers = tile_headers(etag)
+    if z < MVT_MIN_ZOOM:
+        # Themes are too dense to draw below MVT_MIN_ZOOM, send nothing
+        return Response(status_code=204, headers=headers)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    tile_key = f"{table_name}/{z}/{x}/{y}"
+    tile = await tile_cache.get(layer_version, tile_key)
+
+    if tile is None:
+        # Degrees per pixel of a 256px tile at this zoom
+        tolerance = MVT_SIMPLIFY_PIXELS * 360 / (256 * 2 ** z)
+        result = await fetch_prepared(
+            theme_tile_query(table_name, detailed=z >= MVT_DETAIL_ZOOM),
+            z, x, y, tolerance, table_name,
+            fetchrow=True
+        )
+        tile = result["tile"] or EMPTY_TILE
+        await tile_cache.put(layer_version, tile_key, tile)
 
-    try:
-        response = await httpx_client.get(pmtiles_url)
-        response.raise_for_status()
-        return Response(content=response.content, media_type='application/x-protobuf')
-    except httpx.RequestError as e:
-        raise HTTPException(status_code=404, detail=f"Tile not found: {e}")
+    if tile == EMPTY_TILE:
+        return Response(status_code=204, headers=headers)
+    return Response(content=tile, media_type='application/x-protobuf', headers=headers)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8005)
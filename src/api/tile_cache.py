@@ -0,0 +1,194 @@
+import os
+import shutil
+import asyncio
+import tempfile
+
+from collections import OrderedDict
+
+from disk_budget import DiskBudget
+
+TILE_CACHE_DIR = os.getenv("TILE_CACHE_DIR", "/tmp/car_tile_cache")
+TILE_CACHE_MAX_BYTES = int(os.getenv("TILE_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+TILE_CACHE_LOW_WATERMARK = float(os.getenv("TILE_CACHE_LOW_WATERMARK", "0.9"))
+TILE_MEMORY_CACHE_BYTES = int(os.getenv("TILE_MEMORY_CACHE_BYTES", str(64 * 1024 * 1024)))
+TILE_MEMORY_MAX_ZOOM = int(os.getenv("TILE_MEMORY_MAX_ZOOM", "10"))
+
+# Stored for tiles the upstream has no data for
+EMPTY_TILE = b""
+
+
+class TileCache:
+    """Two tier tile cache: per-worker memory LRU plus a shared disk tier.
+
+    Keys look like `{tileset}/{z}/{x}/{y}`. Only low zoom tiles, which every
+    map session requests, are kept in memory; the memory tier also remembers
+    empty tiles at any zoom since they cost nothing. Everything is stored on
+    disk under the tileset version, so a new basemap or release never serves
+    tiles from the previous one, and older versions are dropped by a
+    background task as soon as a newer one is written.
+
+    Disk reads and writes run in threads to keep them off the event loop.
+    The disk tier is kept under `max_bytes` by a DiskBudget, like ExportCache.
+    """
+
+    def __init__(
+        self,
+        cache_dir=TILE_CACHE_DIR,
+        max_bytes=TILE_CACHE_MAX_BYTES,
+        memory_bytes=TILE_MEMORY_CACHE_BYTES,
+        memory_max_zoom=TILE_MEMORY_MAX_ZOOM
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.budget = DiskBudget(
+            os.path.join(cache_dir, ".size"),
+            max_bytes,
+            TILE_CACHE_LOW_WATERMARK,
+            lambda: self.entries(self.cache_dir)
+        )
+        self.memory_bytes = memory_bytes
+        self.memory_max_zoom = memory_max_zoom
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.empty_hits = 0
+        self.versions = {}
+        # Tilesets whose older versions wait for the cleanup task
+        self.stale_tilesets = {}
+        self.cleanup_task = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path_for(self, version, key):
+        tileset, tile = key.split("/", 1)
+        return os.path.join(self.cache_dir, tileset, version, f"{tile}.pbf")
+
+    async def get(self, version, key):
+        memory_key = (version, key)
+        data = self.memory.get(memory_key)
+        if data is not None:
+            self.memory.move_to_end(memory_key)
+            self.memory_hits += 1
+        else:
+            data = await asyncio.to_thread(self.read_tile, self.path_for(version, key))
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.remember(version, key, data)
+
+        if data == EMPTY_TILE:
+            self.empty_hits += 1
+        return data
+
+    @staticmethod
+    def read_tile(path):
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            # Bump the mtime, eviction drops the least recently used tiles
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    async def put(self, version, key, data):
+        tileset = key.split("/", 1)[0]
+        if self.versions.get(tileset) != version:
+            self.versions[tileset] = version
+            self.forget_other_versions(tileset, version)
+            self.stale_tilesets[tileset] = version
+            if self.cleanup_task is None or self.cleanup_task.done():
+                self.cleanup_task = asyncio.ensure_future(self.drop_stale_versions())
+
+        self.remember(version, key, data)
+        await asyncio.to_thread(self.write_tile, self.path_for(version, key), data)
+
+    def write_tile(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            try:
+                replaced_bytes = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced_bytes = 0
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        self.budget.add_bytes(len(data) - replaced_bytes)
+
+    def remember(self, version, key, data):
+        zoom = int(key.rsplit("/", 3)[-3])
+        if data != EMPTY_TILE and zoom > self.memory_max_zoom:
+            return
+        memory_key = (version, key)
+        if memory_key in self.memory:
+            return
+        self.memory[memory_key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.memory_bytes and self.memory:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+
+    def forget_other_versions(self, tileset, version):
+        stale_keys = [
+            (key_version, key) for key_version, key in self.memory
+            if key.startswith(f"{tileset}/") and key_version != version
+        ]
+        for memory_key in stale_keys:
+            self.memory_size -= len(self.memory.pop(memory_key))
+
+    async def drop_stale_versions(self):
+        """Remove tiles of previous tileset versions, one tileset at a time."""
+        while self.stale_tilesets:
+            tileset, version = self.stale_tilesets.popitem()
+            try:
+                await asyncio.to_thread(self.drop_other_versions, tileset, version)
+            except Exception as e:
+                print(f"Tile cache cleanup of {tileset} failed: {e}")
+
+    def drop_other_versions(self, tileset, version):
+        tileset_dir = os.path.join(self.cache_dir, tileset)
+        if not os.path.isdir(tileset_dir):
+            return
+        freed_bytes = 0
+        for entry in os.scandir(tileset_dir):
+            if entry.is_dir() and entry.name != version:
+                freed_bytes += sum(size for _, size, _ in self.entries(entry.path))
+                shutil.rmtree(entry.path, ignore_errors=True)
+        if freed_bytes:
+            self.budget.add_bytes(-freed_bytes)
+
+    def entries(self, directory):
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.startswith("."):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "pid": os.getpid(),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "empty_hits": self.empty_hits,
+            "hit_ratio": (self.memory_hits + self.disk_hits) / lookups if lookups else None,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_size,
+            "evictions": self.budget.evictions,
+            "max_bytes": self.max_bytes,
+        }
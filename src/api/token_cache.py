@@ -0,0 +1,54 @@
+import os
+import hashlib
+
+from collections import OrderedDict
+
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
+
+class TokenCache:
+    """Per-worker LRU of verified tokens and their `exp` timestamp.
+
+    Keys are a short blake2b digest of the token, so the token itself is not
+    kept around. Callers still compare the stored `exp` on every hit, a cached
+    token expires exactly when jwt.decode would have rejected it.
+    """
+
+    def __init__(self, max_size=TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self.tokens = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(token):
+        return hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+
+    def get(self, key):
+        expires_at = self.tokens.get(key)
+        if expires_at is None:
+            self.misses += 1
+            return None
+        self.tokens.move_to_end(key)
+        self.hits += 1
+        return expires_at
+
+    def put(self, key, expires_at):
+        self.tokens[key] = expires_at
+        self.tokens.move_to_end(key)
+        if len(self.tokens) > self.max_size:
+            self.tokens.popitem(last=False)
+
+    def discard(self, key):
+        self.tokens.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "pid": os.getpid(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "entries": len(self.tokens),
+            "max_size": self.max_size,
+        }
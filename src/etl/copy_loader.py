@@ -0,0 +1,196 @@
+import os
+import queue
+import struct
+import threading
+
+from datetime import date
+
+from psycopg2 import sql
+from uuid_extensions import uuid7
+
+copy_chunk_bytes = int(os.getenv("COPY_CHUNK_BYTES", 1024 * 1024))
+
+# PGCOPY binary signature, flags and header extension length
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+NULL_FIELD = struct.pack("!i", -1)
+POSTGRES_EPOCH = date(2000, 1, 1)
+EWKB_SRID_FLAG = 0x20000000
+JSONB_VERSION = b"\x01"
+SRID = 4326
+
+COPY_COLUMNS = (
+    "id",
+    "car_code",
+    "state_code",
+    "release_date",
+    "feature_hash",
+    "geom_hash",
+    "properties_hash",
+    "geom",
+    "properties",
+)
+
+# Columns of the feature hash staging table of delta loads
+HASH_COPY_COLUMNS = (
+    "car_code",
+    "feature_hash",
+)
+
+# Pushed to the queue to end the COPY, or to abort it
+END_OF_DATA = object()
+ABORT = object()
+
+
+def wkb_to_ewkb(wkb, srid=SRID):
+    """Tag OGR WKB with an SRID, the form geometry's binary input expects."""
+    endian = ">" if wkb[0] == 0 else "<"
+    (geom_type,) = struct.unpack_from(endian + "I", wkb, 1)
+    return wkb[:1] + struct.pack(endian + "II", geom_type | EWKB_SRID_FLAG, srid) + wkb[5:]
+
+
+def encode_row(fields):
+    parts = [struct.pack("!h", len(fields))]
+    for field in fields:
+        if field is None:
+            parts.append(NULL_FIELD)
+        else:
+            parts.append(struct.pack("!i", len(field)))
+            parts.append(field)
+    return b"".join(parts)
+
+
+def encode_feature(feature, state_code, release_days):
+    """One COPY binary row for a feature produced by process_geometry.
+
+    `state_code` and `release_days` come already encoded, they are the same
+    for every row of a load.
+    """
+    car_code = feature["properties"].get("cod_imovel")
+    return encode_row((
+        uuid7().bytes,
+        car_code.encode("utf-8") if car_code is not None else None,
+        state_code,
+        release_days,
+        bytes.fromhex(feature["hash"]),
+        bytes.fromhex(feature["geom_hash"]),
+        bytes.fromhex(feature["properties_hash"]),
+        wkb_to_ewkb(feature["geometry"]),
+        JSONB_VERSION + feature["properties_json"],
+    ))
+
+
+def encode_feature_hash(feature):
+    """One COPY binary row with only the car_code and feature_hash of a feature."""
+    car_code = feature["properties"].get("cod_imovel")
+    return encode_row((
+        car_code.encode("utf-8") if car_code is not None else None,
+        bytes.fromhex(feature["hash"]),
+    ))
+
+
+class QueueReader:
+    """File-like object handing queued COPY data to psycopg2's copy_expert."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = memoryview(b"")
+        self.finished = False
+
+    def read(self, size=-1):
+        if not self.buffer:
+            if self.finished:
+                return b""
+            chunk = self.chunks.get()
+            if chunk is ABORT:
+                raise Exception("COPY aborted by the producer")
+            if chunk is END_OF_DATA:
+                self.finished = True
+                return b""
+            self.buffer = memoryview(chunk)
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = self.buffer[:size].tobytes()
+        self.buffer = self.buffer[size:]
+        return data
+
+
+class CopyLoader:
+    """Stream features into one table with binary COPY on a single connection.
+
+    Rows are encoded by the caller's thread and grouped in chunks of
+    COPY_CHUNK_BYTES, which a writer thread feeds to COPY FROM STDIN. The
+    queue between them holds at most `max_buffer_bytes`, so reading the
+    shapefile waits for the database instead of filling memory. Everything
+    is loaded in one transaction, committed by close(). With `hashes_only`
+    only HASH_COPY_COLUMNS are copied, for the staging table of delta loads.
+    """
+
+    def __init__(self, conn, table_name, state, release_date, max_buffer_bytes, hashes_only=False):
+        self.conn = conn
+        self.table_name = table_name
+        self.hashes_only = hashes_only
+        self.columns = HASH_COPY_COLUMNS if hashes_only else COPY_COLUMNS
+        self.state_code = state.upper().encode("utf-8")
+        release_days = (date.fromisoformat(release_date) - POSTGRES_EPOCH).days
+        self.release_days = struct.pack("!i", release_days)
+        self.chunks = queue.Queue(maxsize=max(2, int(max_buffer_bytes // copy_chunk_bytes)))
+        self.chunk = bytearray(COPY_HEADER)
+        self.row_count = 0
+        self.error = None
+        self.writer = threading.Thread(target=self.copy, daemon=True)
+        self.writer.start()
+
+    def copy(self):
+        copy_query = sql.SQL("COPY {table} ({columns}) FROM STDIN WITH (FORMAT binary)").format(
+            table=sql.Identifier(self.table_name),
+            columns=sql.SQL(", ").join(sql.Identifier(column) for column in self.columns)
+        )
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.copy_expert(copy_query, QueueReader(self.chunks), size=copy_chunk_bytes)
+        except Exception as e:
+            self.error = e
+
+    def put(self, item):
+        # Blocks while the queue is full, unless the writer has given up
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                if not self.writer.is_alive():
+                    raise Exception(f"COPY into {self.table_name} stopped")
+
+    def write(self, feature):
+        if self.hashes_only:
+            self.chunk += encode_feature_hash(feature)
+        else:
+            self.chunk += encode_feature(feature, self.state_code, self.release_days)
+        self.row_count += 1
+        if len(self.chunk) >= copy_chunk_bytes:
+            self.put(bytes(self.chunk))
+            self.chunk = bytearray()
+
+    def close(self):
+        """Finish the COPY and commit, returning the number of rows loaded."""
+        self.chunk += COPY_TRAILER
+        self.put(bytes(self.chunk))
+        self.put(END_OF_DATA)
+        self.writer.join()
+        if self.error is not None:
+            self.conn.rollback()
+            raise self.error
+        self.conn.commit()
+        return self.row_count
+
+    def abort(self):
+        if self.writer.is_alive():
+            try:
+                self.put(ABORT)
+            except Exception:
+                pass
+            self.writer.join()
+        self.conn.rollback()
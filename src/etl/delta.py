@@ -0,0 +1,38 @@
+def feature_key(feature):
+    """(car_code, feature_hash) of a feature, the key delta loads compare rows by.
+
+    A missing car_code is keyed as "", as the staging and active rows are
+    grouped with COALESCE(car_code, '').
+    """
+    return feature["properties"].get("cod_imovel") or "", feature["hash"]
+
+
+class AddedRows:
+    """How many rows of each key a release adds to the active partition.
+
+    A key found n times in the release and m times in the active partition
+    adds n - m rows, so a release repeating an identical feature gets as
+    many copies as it has, not one per distinct feature_hash. take() is
+    called for every feature of the release in turn and accepts only that
+    many.
+    """
+
+    def __init__(self, key_counts):
+        self.remaining = {}
+        for car_code, feature_hash, count in key_counts:
+            if count > 0:
+                self.remaining[(car_code, feature_hash)] = count
+
+    def __len__(self):
+        return sum(self.remaining.values())
+
+    def take(self, feature):
+        key = feature_key(feature)
+        count = self.remaining.get(key)
+        if not count:
+            return False
+        if count == 1:
+            del self.remaining[key]
+        else:
+            self.remaining[key] = count - 1
+        return True
@@ -4,32 +4,58 @@ from pathlib import Path
 import json
 import psycopg2
 from datetime import datetime
-from psycopg2.extras import Json, execute_values
+from psycopg2.extras import execute_values
 from psycopg2 import sql
 from uuid_extensions import uuid7str
 from SICAR import Sicar, Polygon, State
+from copy_loader import CopyLoader
+from delta import AddedRows
 from osgeo import ogr
 import psutil
 import hashlib
 import random
 import time
+import subprocess
+from osgeo import gdal
 from random_user_agent.user_agent import UserAgent
 from random_user_agent.params import SoftwareName, OperatingSystem
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime
-from multiprocessing import Manager
+import threading
 
 out_root_folder = os.getenv("OUT_ROOT_FOLDER", "/tmp")
 max_memory_percent_to_use = float(os.getenv("MAX_MEMORY_PERCENT_TO_USE", 0.01))
-max_batch_size = int(os.getenv("MAX_BATCH_SIZE", 100))
 timeout = int(os.getenv("TIMEOUT", 25))
 chunk_size = int(os.getenv("CHUNK_SIZE", 5 * 1024))
 use_proxy = os.getenv("USE_PROXY", "True").lower() in ("true", "1", "yes")
 ip_proxy = os.getenv("IP_PROXY", "http://127.0.0.1:3128")
 use_http2 = os.getenv("USE_HTTP2", "True").lower() in ("true", "1", "yes")
 min_download_rate = int(os.getenv("MIN_DOWNLOAD_RATE", 25))
+# Ingest stage processes, each loading one state/theme into the database
 max_workers = int(os.getenv("MAX_WORKERS", 1))
+# Apply only new, changed and removed rows to the active partition, unless
+# more than DELTA_MAX_CHANGE_RATIO of its rows changed
+delta_loads = os.getenv("DELTA_LOADS", "True").lower() in ("true", "1", "yes")
+delta_max_change_ratio = float(os.getenv("DELTA_MAX_CHANGE_RATIO", 0.3))
+# Download stage threads, bounded by what the SICAR server tolerates
+download_workers = int(os.getenv("DOWNLOAD_WORKERS", 2))
+# Disk downloaded zips may take while they wait for the ingest stage
+spool_max_bytes = int(os.getenv("SPOOL_MAX_BYTES", 20 * 1024 ** 3))
+# Processes loading one shapefile in parallel, each on its own FID range,
+# only once the layer has INGEST_MIN_FEATURES_PER_WORKER features per process
+ingest_workers = int(os.getenv("INGEST_WORKERS", 1))
+ingest_min_features_per_worker = int(os.getenv("INGEST_MIN_FEATURES_PER_WORKER", 250000))
 overwrite = os.getenv("OVERWRITE", "False").lower() in ("true", "1", "yes")
+catalog_channel = os.getenv("CATALOG_CHANNEL", "car_catalog")
+build_pmtiles = os.getenv("BUILD_PMTILES", "False").lower() in ("true", "1", "yes")
+pmtiles_dir = os.getenv("PMTILES_DIR", "/data/pmtiles")
+pmtiles_layer = os.getenv("PMTILES_LAYER", "area_imovel")
+pmtiles_build_workers = int(os.getenv("PMTILES_BUILD_WORKERS", 3))
+# Zoom ranges tiled in parallel, then joined into one archive
+pmtiles_zoom_ranges = [
+    tuple(int(zoom) for zoom in zoom_range.split("-"))
+    for zoom_range in os.getenv("PMTILES_ZOOM_RANGES", "3-9,10-12,13-16").split(",")
+]
 
 proxy = None
 if use_proxy:
@@ -92,23 +118,11 @@ def get_headers():
         "Sec-Fetch-Site": "same-origin",
     }
 
-def extract_zip_to_folder(zip_path, extract_to_folder):
-    zip_path = Path(zip_path)
-    extract_to_folder = Path(extract_to_folder)
-    extract_to_folder.mkdir(parents=True, exist_ok=True)
-    zip_extracted = False
-    try:
-        with zipfile.ZipFile(zip_path, "r") as zip_ref:
-            zip_ref.extractall(extract_to_folder)
-        zip_extracted = True
-    except Exception as e:
-        print(e)
-    finally:
-        try:
-            os.remove(zip_path)
-        except Exception as e:
-            print(e)
-    return zip_extracted
+def zip_shapefile_paths(zip_path):
+    """GDAL paths of the shapefiles in a zip, read in place through /vsizip/."""
+    with zipfile.ZipFile(zip_path, "r") as zip_ref:
+        members = [name for name in zip_ref.namelist() if name.lower().endswith(".shp")]
+    return [f"/vsizip/{Path(zip_path).as_posix()}/{name}" for name in sorted(members)]
 
 def create_statistics_table():
     conn = connect_db()
@@ -134,6 +148,18 @@ def create_statistics_table():
         ON car_statistics (state_code);
     """)
     cursor.execute(create_state_code_index_query)
+    # Columns added after the table was first created: rows removed by a
+    # delta load, and partition extents the API uses to route spatial
+    # lookups to the states that can contain them
+    added_columns_query = sql.SQL("""
+        ALTER TABLE car_statistics
+            ADD COLUMN IF NOT EXISTS count_removed_features INT,
+            ADD COLUMN IF NOT EXISTS xmin DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS ymin DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS xmax DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS ymax DOUBLE PRECISION;
+    """)
+    cursor.execute(added_columns_query)
 
     conn.commit()
     cursor.close()
@@ -205,7 +231,10 @@ def create_partition_and_table( state, theme):
     cursor.close()
     conn.close()
 
-def create_indices(state, theme):
+# Index names are the table name plus these suffixes, renamed with the table
+INDEX_SUFFIXES = ["pkey", "geom_idx", "cod_imovel_idx", "release_date_idx", "feature_hash_idx"]
+
+def create_indices(table_name):
     conn = connect_db()
     cursor = conn.cursor()
     create_spatial_index_query = sql.SQL("""
@@ -213,8 +242,8 @@ def create_indices(state, theme):
         ON {table}
         USING GIST (geom);
     """).format(
-        index_geom=sql.Identifier(f"{theme.lower()}_{state.lower()}_geom_idx"),
-        table=sql.Identifier(f"{theme.lower()}_{state.lower()}")
+        index_geom=sql.Identifier(f"{table_name}_geom_idx"),
+        table=sql.Identifier(table_name)
     )
     cursor.execute(create_spatial_index_query)
 
@@ -222,8 +251,8 @@ def create_indices(state, theme):
         CREATE INDEX IF NOT EXISTS {index_cod_imovel}
         ON {table} (car_code);
     """).format(
-        index_cod_imovel=sql.Identifier(f"{theme.lower()}_{state.lower()}_cod_imovel_idx"),
-        table=sql.Identifier(f"{theme.lower()}_{state.lower()}")
+        index_cod_imovel=sql.Identifier(f"{table_name}_cod_imovel_idx"),
+        table=sql.Identifier(table_name)
     )
     cursor.execute(create_cod_imovel_index_query)
 
@@ -232,10 +261,20 @@ def create_indices(state, theme):
         CREATE INDEX IF NOT EXISTS {index_release_date}
         ON {table} (release_date);
     """).format(
-        index_release_date=sql.Identifier(f"{theme.lower()}_{state.lower()}_release_date_idx"),
-        table=sql.Identifier(f"{theme.lower()}_{state.lower()}")
+        index_release_date=sql.Identifier(f"{table_name}_release_date_idx"),
+        table=sql.Identifier(table_name)
     )
     cursor.execute(create_release_date_index_query)
+
+    # Index on feature_hash, to match rows of the next release in delta loads
+    create_feature_hash_index_query = sql.SQL("""
+        CREATE INDEX IF NOT EXISTS {index_feature_hash}
+        ON {table} (feature_hash);
+    """).format(
+        index_feature_hash=sql.Identifier(f"{table_name}_feature_hash_idx"),
+        table=sql.Identifier(table_name)
+    )
+    cursor.execute(create_feature_hash_index_query)
     conn.commit()
     cursor.close()
     conn.close()
@@ -253,17 +292,28 @@ def vacuum(theme, state):
     cursor.close()
     conn.close()
 
-def insert_statistics_data(feature_count, release_date, layer, state_code):
+def insert_statistics_data(
+    feature_count,
+    release_date,
+    layer,
+    state_code,
+    new_count=0,
+    updated_count=0,
+    removed_count=0
+):
     conn = connect_db()
     cursor = conn.cursor()
 
-    # Query to calculate active, new, and updated features
+    # Count active features and take the partition extent in a single scan
     count_query = sql.SQL("""
-        SELECT COUNT(1) FROM {table} WHERE state_code = %s AND active = 1
-    """).format(table=sql.Identifier(layer.lower()))
+        SELECT total, ST_XMin(extent), ST_YMin(extent), ST_XMax(extent), ST_YMax(extent)
+        FROM (
+            SELECT COUNT(1) AS total, ST_Extent(geom) AS extent
+            FROM {partition}
+        ) s
+    """).format(partition=sql.Identifier(f"{layer.lower()}_{state_code.lower()}"))
 
-    # Execute the query with parameters supplied separately to avoid formatting issues
-    cursor.execute(count_query, (state_code.upper(), ))
+    cursor.execute(count_query)
 
     counts = cursor.fetchone()
 
@@ -277,7 +327,12 @@ def insert_statistics_data(feature_count, release_date, layer, state_code):
             count_active_features,
             count_new_features,
             count_updated_features,
-            count_parsed_features
+            count_removed_features,
+            count_parsed_features,
+            xmin,
+            ymin,
+            xmax,
+            ymax
         )
         VALUES %s
     """)
@@ -289,62 +344,24 @@ def insert_statistics_data(feature_count, release_date, layer, state_code):
             layer,
             release_date,
             counts[0],  # count active features
-            0, # todo count new features
-            0, # todo count updated features
-            feature_count
+            new_count,
+            updated_count,
+            removed_count,
+            feature_count,
+            *counts[1:]  # partition extent, NULL when empty
         )
     ]
 
     # Insert statistics data
     execute_values(cursor, insert_query.as_string(conn), values)
 
+    # Tell API workers to reload their layer catalog, delivered on commit
+    cursor.execute("SELECT pg_notify(%s, %s);", (catalog_channel, f"{state_code.upper()}:{layer}"))
+
     conn.commit()
     cursor.close()
     conn.close()
 
-def insert_data_batch(state, theme, batch, release_date):
-    conn = connect_db()
-    cursor = conn.cursor()
-    # Collect all car codes from the batch
-    table_name = f"{theme.lower()}_temp"
-    # Filter batch to include only new records
-    new_records = [
-        (
-            uuid7str(),
-            feature["properties"]["cod_imovel"],
-            state.upper(),
-            release_date,
-            feature["hash"],
-            feature["geom_hash"],
-            feature["properties_hash"],
-            feature["geometry"],
-            Json(feature["properties"])
-        )
-        for feature in batch
-    ]
-
-    # Insert new records
-    if new_records:
-        insert_query = sql.SQL("""
-            INSERT INTO {table} (
-                id,
-                car_code,
-                state_code,
-                release_date,
-                feature_hash,
-                geom_hash,
-                properties_hash,
-                geom,
-                properties)
-            VALUES %s
-        """).format(
-            table=sql.Identifier(table_name)
-        )
-        execute_values(cursor, insert_query.as_string(conn), new_records)
-        conn.commit()
-
-    cursor.close()
-    conn.close()
 def switch_active_version(state, theme, release_date):
     conn = connect_db()
     cursor = conn.cursor()
@@ -378,6 +395,12 @@ def switch_active_version(state, theme, release_date):
             temp_table=sql.Identifier(temp_table_name),
             table=sql.Identifier(table_name)
         ))
+        # Its indexes were built before the switch, give them the active names
+        for suffix in INDEX_SUFFIXES:
+            cursor.execute(sql.SQL("ALTER INDEX IF EXISTS {temp_index} RENAME TO {index};").format(
+                temp_index=sql.Identifier(f"{temp_table_name}_{suffix}"),
+                index=sql.Identifier(f"{table_name}_{suffix}")
+            ))
 
         # Attach the newly renamed table back as a partition
         # You MUST know the partition range or list constraint here:
@@ -402,7 +425,180 @@ def switch_active_version(state, theme, release_date):
     return done
 
 
-def read_shapefile(shapefile_path):
+def active_row_count(state, theme):
+    """Rows in the active partition, 0 when it does not exist yet."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    table_name = f"{theme.lower()}_{state.lower()}"
+    try:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (table_name,))
+        if not cursor.fetchone()[0]:
+            return 0
+        cursor.execute(sql.SQL("SELECT COUNT(1) FROM {table};").format(
+            table=sql.Identifier(table_name)
+        ))
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def create_hash_table(state, theme):
+    """Unlogged staging table for the (car_code, feature_hash) of each release row."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(sql.SQL("""
+        DROP TABLE IF EXISTS {table};
+        CREATE UNLOGGED TABLE {table} (
+            car_code TEXT,
+            feature_hash UUID
+        );
+    """).format(table=sql.Identifier(f"{theme.lower()}_hashes_{state.lower()}")))
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+def delete_hash_table(state, theme):
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(sql.SQL("DROP TABLE IF EXISTS {table};").format(
+        table=sql.Identifier(f"{theme.lower()}_hashes_{state.lower()}")
+    ))
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+def plan_delta(cursor, state, theme):
+    """Compare the staged release hashes with the active partition.
+
+    Rows are counted per (car_code, feature_hash) on both sides into the
+    delta_keys temp table, so duplicate features are matched one for one.
+    Returns (active_count, added_rows, removed_rows, counts), where a
+    car_code both losing and gaining rows counts as updated.
+    """
+    identifiers = dict(
+        table=sql.Identifier(f"{theme.lower()}_{state.lower()}"),
+        hash_table=sql.Identifier(f"{theme.lower()}_hashes_{state.lower()}"),
+    )
+    cursor.execute(sql.SQL("ANALYZE {hash_table};").format(**identifiers))
+    cursor.execute(sql.SQL("""
+        CREATE TEMP TABLE delta_keys ON COMMIT DROP AS
+        SELECT
+            COALESCE(i.car_code, a.car_code) AS car_code,
+            COALESCE(i.feature_hash, a.feature_hash) AS feature_hash,
+            COALESCE(i.row_count, 0) AS incoming,
+            COALESCE(a.row_count, 0) AS active
+        FROM (
+            SELECT COALESCE(car_code, '') AS car_code, feature_hash, COUNT(1) AS row_count
+            FROM {hash_table}
+            GROUP BY 1, 2
+        ) i
+        FULL JOIN (
+            SELECT COALESCE(car_code, '') AS car_code, feature_hash, COUNT(1) AS row_count
+            FROM {table}
+            GROUP BY 1, 2
+        ) a ON a.car_code = i.car_code AND a.feature_hash = i.feature_hash
+        WHERE COALESCE(i.row_count, 0) <> COALESCE(a.row_count, 0);
+    """).format(**identifiers))
+    cursor.execute(sql.SQL("""
+        SELECT
+            (SELECT COUNT(1) FROM {table}),
+            COALESCE(SUM(added), 0),
+            COALESCE(SUM(removed), 0),
+            COALESCE(SUM(added) FILTER (WHERE removed = 0), 0),
+            COALESCE(SUM(added) FILTER (WHERE removed > 0), 0),
+            COALESCE(SUM(removed) FILTER (WHERE added = 0), 0)
+        FROM (
+            SELECT
+                car_code,
+                SUM(GREATEST(incoming - active, 0)) AS added,
+                SUM(GREATEST(active - incoming, 0)) AS removed
+            FROM delta_keys
+            GROUP BY car_code
+        ) per_car;
+    """).format(**identifiers))
+    active_count, added_rows, removed_rows, new_count, updated_count, removed_count = cursor.fetchone()
+    counts = {"new": new_count, "updated": updated_count, "removed": removed_count}
+    return active_count, added_rows, removed_rows, counts
+
+
+def apply_delta(shapefiles, state, theme, release_date, max_buffer_bytes):
+    """Apply a release whose hashes are staged to the active partition.
+
+    When at most `delta_max_change_ratio` of the active rows differ, surplus
+    rows of each key are deleted and the shapefiles are read again to COPY
+    only the features of keys the release has more of, all in a single
+    transaction. Returns (applied, counts); counts are filled either way so
+    they can be recorded after a full switch too.
+    """
+    conn = connect_db()
+    cursor = conn.cursor()
+    table_name = f"{theme.lower()}_{state.lower()}"
+    counts = {"new": 0, "updated": 0, "removed": 0}
+    loader = None
+    applied = False
+    try:
+        active_count, added_rows, removed_rows, counts = plan_delta(cursor, state, theme)
+        change_ratio = (added_rows + removed_rows) / max(active_count, 1)
+        print(f"{state} {theme}: {added_rows} rows to add, {removed_rows} to remove, change ratio {change_ratio:.3f}")
+        if active_count == 0 or change_ratio > delta_max_change_ratio:
+            conn.rollback()
+            return applied, counts
+
+        # Keep the oldest rows of a key (uuid7 ids grow with time), so drop
+        # its surplus over the release starting from the newest
+        cursor.execute(sql.SQL("""
+            DELETE FROM {table} a
+            USING (
+                SELECT ranked.id
+                FROM (
+                    SELECT
+                        t.id,
+                        ROW_NUMBER() OVER (PARTITION BY k.car_code, k.feature_hash ORDER BY t.id DESC) AS position,
+                        k.active - k.incoming AS surplus
+                    FROM {table} t
+                    JOIN delta_keys k
+                        ON k.car_code = COALESCE(t.car_code, '') AND k.feature_hash = t.feature_hash
+                    WHERE k.active > k.incoming
+                ) ranked
+                WHERE ranked.position <= ranked.surplus
+            ) removed
+            WHERE a.id = removed.id;
+        """).format(table=sql.Identifier(table_name)))
+
+        cursor.execute("""
+            SELECT car_code, replace(feature_hash::text, '-', ''), incoming - active
+            FROM delta_keys
+            WHERE incoming > active;
+        """)
+        added = AddedRows(cursor.fetchall())
+
+        # The COPY runs on this connection, inside the same transaction
+        loader = CopyLoader(conn, table_name, state, release_date, max_buffer_bytes)
+        for shapefile in shapefiles:
+            for feature in read_shapefile(shapefile):
+                if added.take(feature):
+                    loader.write(feature)
+        if len(added):
+            raise Exception(f"{len(added)} rows to add were not found in the release")
+        loader.close()
+        applied = True
+    except Exception as e:
+        if loader is not None:
+            loader.abort()
+        else:
+            conn.rollback()
+        print(f"An error occurred on delta load: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+    return applied, counts
+
+
+def read_shapefile(shapefile_path, start=0, stop=None):
+    """Yield processed features, optionally only those with FID in [start, stop)."""
     # Open the shapefile using OGR
     driver = ogr.GetDriverByName("ESRI Shapefile")
     datasource = driver.Open(shapefile_path, 0)  # 0 means read-only
@@ -413,9 +609,16 @@ def read_shapefile(shapefile_path):
 
     # Get the first (and usually only) layer
     layer = datasource.GetLayer()
-
-    # Iterate over each feature in the layer
-    for feature in layer:
+    if start:
+        # Shapefile FIDs are record numbers, the .shx gives their offsets
+        layer.SetNextByIndex(start)
+
+    # Iterate over each feature in the layer (iterating the layer itself
+    # would rewind it to the first feature)
+    while True:
+        feature = layer.GetNextFeature()
+        if feature is None or (stop is not None and feature.GetFID() >= stop):
+            break
         try:
             # Convert the feature's geometry to GeoJSON
             geom = feature.GetGeometryRef()
@@ -430,6 +633,13 @@ def read_shapefile(shapefile_path):
             continue
 
 
+def shapefile_feature_count(shapefile_path):
+    datasource = ogr.Open(shapefile_path, 0)
+    if datasource is None:
+        raise FileNotFoundError(f"Could not open {shapefile_path}")
+    return datasource.GetLayer().GetFeatureCount()
+
+
 def process_geometry(feature, geom):
     # Export geometry to WKB
     wkb = geom.ExportToWkb()
@@ -452,6 +662,7 @@ def process_geometry(feature, geom):
     yield {
         "geometry": wkb,
         "properties": properties,
+        "properties_json": properties_str_encode,
         "size": object_size,
         "hash": feature_hash,
         "geom_hash": geom_hash,
@@ -510,66 +721,135 @@ def create_temp_table(state, theme):
         cursor.close()
         conn.close()
 
-def process_shapefiles_and_save_to_db(extracted_folder, state, theme, release_date):
+def load_shapefile_range(shapefile, start, stop, table_name, state, release_date, max_buffer_bytes, hashes_only=False):
+    """COPY the features of one FID range into `table_name`, on its own connection."""
+    loader = CopyLoader(
+        connect_db(),
+        table_name,
+        state,
+        release_date,
+        max_buffer_bytes,
+        hashes_only=hashes_only
+    )
+    try:
+        for feature in read_shapefile(shapefile, start, stop):
+            loader.write(feature)
+        return loader.close()
+    except BaseException:
+        loader.abort()
+        raise
+    finally:
+        loader.conn.close()
 
-    # Get total available RAM in bytes and divide by 10 for batch size
-    max_batch_size_bytes = psutil.virtual_memory().available * max_memory_percent_to_use
+def load_shapefile(shapefile, table_name, state, release_date, max_buffer_bytes, hashes_only=False):
+    """Load a shapefile, split in FID ranges over INGEST_WORKERS processes when large.
 
-    extracted_folder = Path(extracted_folder)
+    Returns the number of features loaded, summed over every range.
+    """
+    total_features = shapefile_feature_count(shapefile)
+    workers = max(1, min(ingest_workers, total_features // ingest_min_features_per_worker))
+    if workers == 1:
+        return load_shapefile_range(
+            shapefile, 0, None, table_name, state, release_date, max_buffer_bytes, hashes_only
+        )
+
+    print(f"Loading {total_features} features of {shapefile} with {workers} workers")
+    bounds = [total_features * i // workers for i in range(workers + 1)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                load_shapefile_range,
+                shapefile,
+                bounds[i],
+                bounds[i + 1],
+                table_name,
+                state,
+                release_date,
+                max_buffer_bytes / workers,
+                hashes_only
+            )
+            for i in range(workers)
+        ]
+        return sum(future.result() for future in futures)
+
+def process_shapefiles_and_save_to_db(zip_path, state, theme, release_date):
+
+    # Share of the available RAM rows may wait in before the COPY takes them
+    max_buffer_bytes = psutil.virtual_memory().available * max_memory_percent_to_use
+
+    done = False
     try:
-        shapefiles = list(extracted_folder.glob("**/*.shp"))
+        # Shapefiles are read straight out of the zip, nothing is extracted
+        shapefiles = zip_shapefile_paths(zip_path)
         feature_count = 0
-        print("deleting temp table")
-        delete_temp_table(state, theme)
-        print("creating temp table")
-        create_temp_table(state, theme)
-
-        for shapefile in shapefiles:
-            print("inserting into database...")
-            batch_size_bytes = 0
-            batch = []
-
-            for feature in read_shapefile(shapefile.as_posix()):
-                batch.append(feature)
-                batch_size_bytes += feature["size"]
-                feature_count += 1
-
-                if batch_size_bytes >= max_batch_size_bytes or len(batch)>=max_batch_size:
-                    # Submit a batch for insertion
-                    insert_data_batch(state, theme, batch, release_date)
-                    batch = []
-                    batch_size_bytes = 0
-
-            # Insert any remaining features in the batch
-            if batch:
-                insert_data_batch(state, theme, batch, release_date)
-
-            # Clean up the shapefile and its associated files
-            for ext in [".shp", ".prj", ".shx", ".dbf", ".fix"]:
-                try:
-                    os.remove(shapefile.with_suffix(ext))
-                except Exception as e:
-                    print(f"Error removing file {shapefile.with_suffix(ext)}: {e}")
-
-
-        # Create indices
-        print("Creating indexes")
-        create_indices(state, theme)
-        # insert statistics
-        print("Inserting from temp to real table")
-        done = switch_active_version(state, theme, release_date)
+        counts = None
+        if delta_loads and active_row_count(state, theme) > 0:
+            # Stage only the keys of the release, geometries and properties
+            # are copied later for the rows that are actually new
+            print("Staging feature hashes")
+            create_hash_table(state, theme)
+            try:
+                for shapefile in shapefiles:
+                    feature_count += load_shapefile(
+                        shapefile,
+                        f"{theme.lower()}_hashes_{state.lower()}",
+                        state,
+                        release_date,
+                        max_buffer_bytes,
+                        hashes_only=True
+                    )
+                print("Comparing with active version")
+                done, counts = apply_delta(shapefiles, state, theme, release_date, max_buffer_bytes)
+            finally:
+                delete_hash_table(state, theme)
         if done:
-            insert_statistics_data(feature_count, release_date, theme, state)
+            print("Delta applied")
+            create_indices(f"{theme.lower()}_{state.lower()}")
+        else:
+            print("deleting temp table")
+            delete_temp_table(state, theme)
+            print("creating temp table")
+            create_temp_table(state, theme)
+
+            feature_count = 0
+            for shapefile in shapefiles:
+                print("inserting into database...")
+                feature_count += load_shapefile(
+                    shapefile,
+                    f"{theme.lower()}_temp_{state.lower()}",
+                    state,
+                    release_date,
+                    max_buffer_bytes
+                )
+            if counts is None:
+                counts = {"new": feature_count, "updated": 0, "removed": 0}
+
+            # Create indices
+            print("Creating indexes")
+            create_indices(f"{theme.lower()}_temp_{state.lower()}")
+            print("Inserting from temp to real table")
+            done = switch_active_version(state, theme, release_date)
+        if done:
+            # insert statistics
+            insert_statistics_data(
+                feature_count,
+                release_date,
+                theme,
+                state,
+                counts["new"],
+                counts["updated"],
+                counts["removed"]
+            )
             print("Vacuuming")
             vacuum(theme, state)
     except Exception as e:
         print(f"Error inserting shapefile: {e}")
     finally:
-        for file in list(extracted_folder.glob("**/*")):
-            try:
-                os.remove(file)
-            except Exception as e:
-                print(f"Could not remove file: {e}")
+        try:
+            os.remove(zip_path)
+        except Exception as e:
+            print(f"Could not remove file: {e}")
+    return done
 
 
 def get_car( state, theme, out_folder):
@@ -664,48 +944,191 @@ def clean_orphan_rows(state, theme, release_date):
         cursor.close()
         conn.close()
 
-def process_state_theme_pair(state, theme, release_dates, done_list):
-    try:
-        if not state in release_dates:
-            done_list["undone"].append((state, theme))
-            return
-
-        release_date = datetime.strptime(release_dates[state], "%d/%m/%Y").strftime("%Y-%m-%d")
-        check_data_already = check_data_exists(state, theme, release_date)
+class DownloadSpool:
+    """Disk budget shared by downloaded zips waiting to be ingested.
 
-        #if not check_data_already:
-        #clean_orphan_rows(state, theme, release_date)
-        if check_data_already:
-            done_list["done"].append((state, theme))
-            print(f"Data already exists for {state}, {theme}")
-            return
+    A download only starts while the spool is under `max_bytes`; the zip
+    size is added once it lands and released after it has been loaded.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.condition = threading.Condition()
 
-        state_folder = os.path.join(out_root_folder, state)
-        out_folder = os.path.join(state_folder, theme)
+    def wait_for_room(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.used_bytes < self.max_bytes)
 
-        os.makedirs(out_folder, exist_ok=True)
+    def add(self, size):
+        with self.condition:
+            self.used_bytes += size
 
-        result = get_car(state, theme, out_folder)
-        if not result:
-            done_list["undone"].append((state, theme))
-            return
+    def release(self, size):
+        with self.condition:
+            self.used_bytes -= size
+            self.condition.notify_all()
 
-        result_path = result.as_posix()
+def download_state_theme(state, theme, release_dates, spool):
+    """Download stage, returns (release_date, zip_path, zip_size) or None when there is nothing to load.
 
-        print("Extracting zip")
-        extracted_zip = extract_zip_to_folder(result_path, out_folder)
-        if not extracted_zip:
-            raise Exception("zip not extractable")
+    `zip_size` is what the zip took from the spool, the caller releases it
+    once the load is done since the zip is deleted by then.
+    """
+    release_date = datetime.strptime(release_dates[state], "%d/%m/%Y").strftime("%Y-%m-%d")
+    if check_data_exists(state, theme, release_date):
+        print(f"Data already exists for {state}, {theme}")
+        return None
+
+    out_folder = os.path.join(out_root_folder, state, theme)
+    os.makedirs(out_folder, exist_ok=True)
+
+    spool.wait_for_room()
+    result = get_car(state, theme, out_folder)
+    if not result:
+        raise Exception("download failed")
+    zip_path = result.as_posix()
+    zip_size = os.path.getsize(zip_path)
+    spool.add(zip_size)
+    return release_date, zip_path, zip_size
+
+def load_state_theme(state, theme, release_date, zip_path):
+    """Ingest stage, runs in a worker process."""
+    try:
+        if not zipfile.is_zipfile(zip_path):
+            raise Exception("zip not readable")
 
         print("Creating schema and table")
         create_partition_and_table(state, theme)
         print("Processing shapefile")
-        process_shapefiles_and_save_to_db(out_folder, state, theme, release_date)
+        loaded = process_shapefiles_and_save_to_db(zip_path, state, theme, release_date)
         print(f"Done processing {state}, {theme}")
-        done_list["done"].append((state, theme))
+        return loaded
+    finally:
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+
+def pg_connection_string():
+    return " ".join([
+        f"dbname={os.getenv('POSTGRES_DB')}",
+        f"user={os.getenv('POSTGRES_USER')}",
+        f"password={os.getenv('POSTGRES_PASSWORD')}",
+        f"host={os.getenv('POSTGRES_HOST')}",
+        f"port={os.getenv('POSTGRES_PORT')}",
+    ])
+
+def export_state_basemap(state, build_folder):
+    """Export the active basemap partition of a state to FlatGeobuf."""
+    table_name = f"{pmtiles_layer}_{state.lower()}"
+    out_path = os.path.join(build_folder, f"{table_name}.fgb")
+    tmp_path = os.path.join(build_folder, f"{table_name}.tmp.fgb")
+    dataset = gdal.VectorTranslate(
+        tmp_path,
+        f"PG:{pg_connection_string()}",
+        format="FlatGeobuf",
+        SQLStatement=f"""
+            SELECT car_code, properties->>'ind_status' AS ind_status, geom
+            FROM {table_name}
+        """,
+        layerName=pmtiles_layer,
+    )
+    if dataset is None:
+        raise Exception(f"Could not export {table_name}")
+    dataset = None
+    os.replace(tmp_path, out_path)
+    return out_path
+
+def tile_zoom_range(source_path, min_zoom, max_zoom):
+    out_path = source_path.replace(".fgb", f".z{min_zoom}-{max_zoom}.pmtiles")
+    subprocess.run([
+        "tippecanoe",
+        "--force",
+        "--quiet",
+        f"--output={out_path}",
+        f"--layer={pmtiles_layer}",
+        f"--minimum-zoom={min_zoom}",
+        f"--maximum-zoom={max_zoom}",
+        "--drop-densest-as-needed",
+        source_path,
+    ], check=True)
+    return out_path
+
+def basemap_states():
+    """States with a loaded basemap layer, whether or not loaded by this run."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT DISTINCT state_code
+        FROM car_statistics
+        WHERE lower(layer) = %s;
+    """, (pmtiles_layer,))
+    state_codes = sorted(row[0] for row in cursor.fetchall())
+    cursor.close()
+    conn.close()
+    return state_codes
+
+def state_archive_paths(state, build_folder):
+    table_name = f"{pmtiles_layer}_{state.lower()}"
+    return [
+        os.path.join(build_folder, f"{table_name}.z{min_zoom}-{max_zoom}.pmtiles")
+        for min_zoom, max_zoom in pmtiles_zoom_ranges
+    ]
+
+def tile_state_basemap(state, build_folder):
+    """Export a state's basemap partition and tile it in parallel per zoom range."""
+    print(f"Exporting {state} basemap")
+    source_path = export_state_basemap(state, build_folder)
+
+    print(f"Tiling {state} basemap")
+    with ThreadPoolExecutor(max_workers=pmtiles_build_workers) as executor:
+        list(executor.map(
+            lambda zoom_range: tile_zoom_range(source_path, *zoom_range),
+            pmtiles_zoom_ranges
+        ))
+    os.remove(source_path)
+
+def build_state_pmtiles(state=None):
+    """Re-tile one state and rebuild the basemap archive from every state.
+
+    States loaded before, e.g. skipped by this run since their release was
+    already in the database, are tiled first if they have no archives yet,
+    so the joined basemap always covers every loaded state. The archives are
+    joined into a temporary file that atomically replaces the archive the
+    API serves. Without `state` only the missing states are tiled.
+    """
+    build_folder = os.path.join(pmtiles_dir, "build")
+    os.makedirs(build_folder, exist_ok=True)
+    try:
+        if state is not None:
+            tile_state_basemap(state, build_folder)
+
+        state_archives = []
+        for state_code in basemap_states():
+            archive_paths = state_archive_paths(state_code, build_folder)
+            if not all(os.path.exists(path) for path in archive_paths):
+                tile_state_basemap(state_code, build_folder)
+            missing = [path for path in archive_paths if not os.path.exists(path)]
+            if missing:
+                raise Exception(f"Basemap archives missing for {state_code}: {missing}")
+            state_archives.extend(archive_paths)
+
+        archive_path = os.path.join(pmtiles_dir, f"{pmtiles_layer}.pmtiles")
+        tmp_archive_path = os.path.join(pmtiles_dir, f"{pmtiles_layer}.building.pmtiles")
+
+        print(f"Joining {len(state_archives)} basemap archives")
+        subprocess.run([
+            "tile-join",
+            "--force",
+            "--quiet",
+            "--no-tile-size-limit",
+            f"--output={tmp_archive_path}",
+            *state_archives,
+        ], check=True)
+        os.replace(tmp_archive_path, archive_path)
+        print(f"Basemap {archive_path} updated with {state or 'missing states'}")
+        return True
     except Exception as e:
-        print(f"Error processing {state}, {theme}: {e}")
-        done_list["undone"].append((state, theme))
+        print(f"Error building basemap for {state or 'missing states'}: {e}")
+        return False
 
 def main():
     car = Sicar(
@@ -719,30 +1142,81 @@ def main():
     create_statistics_table()
     release_dates = car.get_release_dates()
 
-    # Use a Manager to create a shared done_list dictionary
-    with Manager() as manager:
-        done_list = manager.dict()
-        done_list["undone"] = manager.list()
-        done_list["done"] = manager.list()
-
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = []
-            for state in states:
-                for theme in themes:
-                    print(f"Submitting task for {state}, {theme}")
-                    futures.append(executor.submit(process_state_theme_pair, state, theme, release_dates, done_list))
-
-            for future in as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"Error during processing: {e}")
-
-        if len(done_list["undone"]) == 0:
-            time.sleep(3600)
-            return True
-        time.sleep(60)
-        return False
+    done = []
+    undone = []
+    spool = DownloadSpool(spool_max_bytes)
+
+    # Downloads, loads and basemap builds each run in their own pool, so the
+    # next state downloads while the current one is loaded. Basemap builds
+    # run one at a time since each one joins every state's tiles
+    load_executor = ProcessPoolExecutor(max_workers=max_workers)
+    tiles_executor = ProcessPoolExecutor(max_workers=1) if build_pmtiles else None
+    # Fork every worker process now, before download threads exist
+    for executor, workers in ((load_executor, max_workers), (tiles_executor, 1)):
+        if executor is not None:
+            for future in [executor.submit(os.getpid) for _ in range(workers)]:
+                future.result()
+    download_executor = ThreadPoolExecutor(max_workers=download_workers)
+    tiles_futures = []
+
+    pending = {}
+    for state in states:
+        for theme in themes:
+            if state not in release_dates:
+                undone.append((state, theme))
+                continue
+            print(f"Submitting download for {state}, {theme}")
+            future = download_executor.submit(download_state_theme, state, theme, release_dates, spool)
+            pending[future] = ("download", state, theme, 0)
+
+    while pending:
+        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in finished:
+            stage, state, theme, zip_size = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error during {stage} of {state}, {theme}: {e}")
+                undone.append((state, theme))
+                spool.release(zip_size)
+                continue
+
+            if stage == "download":
+                if result is None:
+                    done.append((state, theme))
+                    continue
+                release_date, zip_path, zip_size = result
+                print(f"Submitting load for {state}, {theme}")
+                load_future = load_executor.submit(load_state_theme, state, theme, release_date, zip_path)
+                pending[load_future] = ("load", state, theme, zip_size)
+                continue
+
+            spool.release(zip_size)
+            if not result:
+                undone.append((state, theme))
+                continue
+            done.append((state, theme))
+            if tiles_executor is not None and theme.lower() == pmtiles_layer:
+                print(f"Submitting basemap build for {state}")
+                tiles_futures.append(tiles_executor.submit(build_state_pmtiles, state))
+
+    download_executor.shutdown()
+    load_executor.shutdown()
+    if tiles_executor is not None:
+        archive_path = os.path.join(pmtiles_dir, f"{pmtiles_layer}.pmtiles")
+        if not tiles_futures and not os.path.exists(archive_path):
+            # Nothing new was loaded, still build the basemap once
+            print("Submitting basemap build for the loaded states")
+            tiles_futures.append(tiles_executor.submit(build_state_pmtiles))
+        for future in as_completed(tiles_futures):
+            future.result()
+        tiles_executor.shutdown()
+
+    if len(undone) == 0:
+        time.sleep(3600)
+        return True
+    time.sleep(60)
+    return False
 
 if __name__=="__main__":
     main()
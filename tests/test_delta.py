@@ -0,0 +1,54 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "etl"))
+
+from delta import AddedRows, feature_key
+
+HASH_A = "0cc175b9c0f1b6a831c399e269772661"
+HASH_B = "92eb5ffee6ae2fec3ad71c777531578f"
+
+
+def make_feature(car_code, feature_hash):
+    return {"properties": {"cod_imovel": car_code}, "hash": feature_hash}
+
+
+def test_duplicate_features_added_once_per_missing_row():
+    # The release has feature A twice, the active partition once, so the
+    # delta keys hold one A to add
+    release = [
+        make_feature("GO-1", HASH_A),
+        make_feature("GO-1", HASH_A),
+        make_feature("GO-2", HASH_B),
+    ]
+    added = AddedRows([("GO-1", HASH_A, 1), ("GO-2", HASH_B, 1)])
+
+    taken = [feature for feature in release if added.take(feature)]
+
+    assert taken == [release[0], release[2]]
+    assert len(added) == 0
+
+
+def test_duplicate_features_already_active_are_not_added():
+    # Same count on both sides, the key is not in the delta at all
+    release = [make_feature("GO-1", HASH_A), make_feature("GO-1", HASH_A)]
+    added = AddedRows([])
+
+    assert not any(added.take(feature) for feature in release)
+
+
+def test_all_duplicates_added_for_a_new_key():
+    release = [make_feature("GO-1", HASH_A)] * 3
+    added = AddedRows([("GO-1", HASH_A, 3), ("GO-3", HASH_B, 0)])
+
+    assert len(added) == 3
+    assert [added.take(feature) for feature in release] == [True, True, True]
+    assert not added.take(make_feature("GO-1", HASH_A))
+
+
+def test_missing_car_code_matches_coalesced_key():
+    feature = {"properties": {"cod_imovel": None}, "hash": HASH_A}
+    added = AddedRows([("", HASH_A, 1)])
+
+    assert feature_key(feature) == ("", HASH_A)
+    assert added.take(feature)